@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
 
+from onionbalance.registry import ServiceRegistry
+
 """
 Define default config options for the management server
 """
@@ -13,16 +15,40 @@ DESCRIPTOR_VALIDITY_PERIOD = 24 * 60 * 60
 DESCRIPTOR_OVERLAP_PERIOD = 60 * 60
 DESCRIPTOR_UPLOAD_PERIOD = 60 * 60  # Re-upload descriptor every hour
 REFRESH_INTERVAL = 10 * 60
+MIN_REFRESH_INTERVAL = 60
+MAX_REFRESH_INTERVAL = 30 * 60
+FETCH_CHECK_INTERVAL = 30  # How often to check for instances due a fetch
 PUBLISH_CHECK_INTERVAL = 5 * 60
+WARMUP_TIMEOUT = 15  # Longest wait for instance descriptors at startup
+STABLE_INTRO_POINTS = True  # Keep published intro points while available
+DISTINCT_REPLICA_INTRO_POINTS = False  # Different intro points per replica
+LOAD_REPORT_MAX_AGE = 10 * 60  # Ignore instance load reports older than this
+LOAD_WEIGHT_FLOOR = 0.1  # Fraction of its weight kept by a saturated instance
+DESCRIPTOR_CACHE_SIZE = 4096  # Recently received descriptors to remember
+INTRO_POINT_CACHE_SIZE = 4  # Decoded intro point sets kept per instance
+PARSE_WORKERS = 2  # Threads used to parse received descriptors
+PARSE_QUEUE_SIZE = 1024  # Received descriptors waiting to be parsed
+SIGNING_WORKERS = 0  # Processes used to sign descriptors, 0 to sign inline
+SIGNING_TIMEOUT = 30  # Sign in process if the signing pool does not respond
+FETCH_TIMEOUT = 2 * 60  # Give up on outstanding HSFETCH requests
+UPLOAD_RETRY_INTERVAL = 5  # Delay before the first retry of a failed upload
+UPLOAD_RETRY_MAX_INTERVAL = 10 * 60  # Cap on the upload retry backoff
+UPLOAD_RETRY_QUEUE_SIZE = 256  # Failed uploads waiting to be retried
+UPLOAD_RETRIES = 6
+HSPOST_TIMEOUT = 30  # Wait for Tor to reply to pipelined HSPOST commands
+METRICS_ADDRESS = '127.0.0.1'
+METRICS_PORT = None  # Serve metrics over HTTP on this port if set
+STATE_SAVE_DELAY = 30  # Coalesce state changes before saving them
 
 LOG_LOCATION = os.environ.get('ONIONBALANCE_LOG_LOCATION')
 CONTROL_SOCKET_LOCATION = os.environ.get(
     'ONIONBALANCE_CONTROL_SOCKET_LOCATION', '/var/run/onionbalance/control')
 LOG_LEVEL = os.environ.get('ONIONBALANCE_LOG_LEVEL', 'info')
+STATE_LOCATION = os.environ.get('ONIONBALANCE_STATE_LOCATION')
 
 TOR_ADDRESS = '127.0.0.1'
 TOR_PORT = 9051
 TOR_CONTROL_PASSWORD = None
 
 # Store global data about onion services and their instance nodes.
-services = []
+services = ServiceRegistry()
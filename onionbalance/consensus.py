@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Determine the hidden service directories responsible for a descriptor
+from the network consensus known to the management Tor client.
+"""
+import binascii
+import bisect
+import threading
+
+import stem
+
+from onionbalance import log
+
+logger = log.get_logger()
+
+# Number of consecutive HSDirs which store each descriptor replica
+HSDIR_SPREAD = 3
+
+
+class HSDirRing(object):
+    """
+    Sorted ring of the fingerprints of all relays with the HSDir flag.
+
+    The ring is loaded from the network statuses known to the controller and
+    updated incrementally when a new consensus arrives. The HSDirs
+    responsible for a descriptor ID are found with a binary search.
+    """
+
+    def __init__(self):
+        self._fingerprints = []
+
+        # NEWCONSENSUS events arrive on the stem event thread
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def refresh(self, controller):
+        """
+        Load the HSDirs from the current consensus of the controller
+        """
+        try:
+            router_statuses = controller.get_network_statuses()
+        except stem.ControllerError:
+            logger.exception("Unable to retrieve the network consensus.")
+            return
+        self.update(router_statuses)
+
+    def update(self, router_statuses):
+        """
+        Update the ring from the router status entries of a new consensus
+
+        Only HSDirs which joined or left the consensus are inserted or
+        removed from the ring.
+        """
+        hsdirs = set(router_status.fingerprint for router_status
+                     in router_statuses if 'HSDir' in router_status.flags)
+
+        with self._lock:
+            removed = set(self._fingerprints) - hsdirs
+            added = hsdirs.difference(self._fingerprints)
+
+            for fingerprint in removed:
+                del self._fingerprints[bisect.bisect_left(self._fingerprints,
+                                                          fingerprint)]
+            for fingerprint in added:
+                bisect.insort(self._fingerprints, fingerprint)
+
+        logger.debug("Updated the HSDir ring with %d HSDirs (%d added, "
+                     "%d removed).", len(hsdirs), len(added), len(removed))
+
+    def get_responsible_hsdirs(self, descriptor_id, spread=HSDIR_SPREAD):
+        """
+        Find the HSDirs responsible for storing a descriptor
+
+        The responsible HSDirs are the `spread` HSDirs whose fingerprints
+        immediately follow the descriptor ID on the ring.
+        """
+        descriptor_id_hex = binascii.hexlify(descriptor_id).decode().upper()
+
+        with self._lock:
+            num_hsdirs = len(self._fingerprints)
+            start = bisect.bisect_right(self._fingerprints, descriptor_id_hex)
+            return [self._fingerprints[(start + i) % num_hsdirs]
+                    for i in range(min(spread, num_hsdirs))]
+
+
+# HSDirs from the consensus of the management Tor client
+hsdir_ring = HSDirRing()
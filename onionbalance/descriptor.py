@@ -3,19 +3,68 @@ import hashlib
 import base64
 import textwrap
 import datetime
+import time
+import heapq
 import random
+import threading
+import queue
 
 import Crypto.Util.number
 import stem
+import stem.connection
+import stem.descriptor.hidden_service_descriptor
+import stem.socket
 
 from onionbalance import util
 from onionbalance import log
 from onionbalance import config
+from onionbalance import metrics
+from onionbalance import state
 
 logger = log.get_logger()
 
+# Digests of recently processed descriptors, mapped to their onion address
+received_descriptor_cache = util.LRUCache(config.DESCRIPTOR_CACHE_SIZE)
 
-def choose_introduction_point_set(available_introduction_points):
+
+def allocate_introduction_points(ips_per_instance, weights, num_slots):
+    """
+    Determine how many introduction points to take from each instance
+
+    Each slot is given to the instance with spare IPs which has the fewest
+    slots relative to its weight, with ties going to the earliest instance.
+    With equal weights the slots are therefore handed out round-robin.
+
+    The instances are kept in a heap ordered by the share they would have
+    after receiving their next slot, so the allocation takes
+    O(instances + slots * log(instances)) time. Instances with a weight of
+    zero only receive the slots which no other instance can fill, shared
+    round-robin between them.
+
+    Return a list with the number of slots for each instance.
+    """
+    def share(pos, slots):
+        if weights[pos] > 0:
+            return (0, slots / float(weights[pos]))
+        return (1, slots)
+
+    intro_selection = [0] * len(ips_per_instance)
+    heap = [(share(pos, 1), pos)
+            for pos in range(len(ips_per_instance)) if ips_per_instance[pos]]
+    heapq.heapify(heap)
+
+    for _ in range(min(num_slots, sum(ips_per_instance))):
+        _, pos = heapq.heappop(heap)
+        intro_selection[pos] += 1
+        if intro_selection[pos] < ips_per_instance[pos]:
+            heapq.heappush(heap, (share(pos, intro_selection[pos] + 1), pos))
+
+    return intro_selection
+
+
+def choose_introduction_point_set(available_introduction_points,
+                                  published_identifiers=None, weights=None,
+                                  rng=random):
     """
     Select a set introduction points to included in a HS descriptor.
 
@@ -24,16 +73,35 @@ def choose_introduction_point_set(available_introduction_points):
 
     Introduciton points are selected to try and achieve the greatest
     distribution of introduction points across all of the available backend
-    instances.
+    instances. If a list of `weights` is provided, each instance receives a
+    share of the introduction points proportional to its weight.
+
+    If the identifiers of the previously published introduction points are
+    provided in `published_identifiers`, those which are still available
+    are kept in preference to new ones. Only as many introduction points
+    are replaced as needed to keep the distribution across instances even.
+
+    Random choices are made with `rng`, which can be a seeded
+    `random.Random` instance to make the selection reproducible.
 
     Return a list of IntroductionPoints.
     """
+    if weights is None:
+        weights = [1] * len(available_introduction_points)
+    instances = list(zip(available_introduction_points, weights))
 
     # Shuffle the instance order before beginning to pick intro points
-    random.shuffle(available_introduction_points)
+    rng.shuffle(instances)
 
-    num_active_instances = len(available_introduction_points)
-    ips_per_instance = [len(ips) for ips in available_introduction_points]
+    if published_identifiers:
+        # Give any spare introduction point slots to the instances with the
+        # most published introduction points so they can keep them
+        instances.sort(
+            key=lambda instance: -sum(
+                1 for ip in instance[0]
+                if ip.identifier in published_identifiers))
+
+    ips_per_instance = [len(ips) for ips, _ in instances]
     num_intro_points = sum(ips_per_instance)
 
     # Choose up to `MAX_INTRO_POINTS` IPs from the service instances. If less
@@ -42,60 +110,126 @@ def choose_introduction_point_set(available_introduction_points):
     max_introduction_points = min(num_intro_points,
                                   config.MAX_INTRO_POINTS)
 
-    # Determine the maximum number of IP's which can be selected from
-    # each instance to give the widest distribution of introduction
-    # point
-    pos = 0
-    intro_selection = [0] * num_active_instances
-
-    # Keep looping until we have selected enough introduction points
-    while sum(intro_selection) < max_introduction_points:
-        # Check if the current instance has more IPs available
-        if(ips_per_instance[pos] - intro_selection[pos] > 0):
-            intro_selection[pos] += 1
-        # Increment and wrap the pointer to the current instance
-        pos = ((pos + 1) % num_active_instances)
+    # Determine the number of IP's which should be selected from each
+    # instance
+    intro_selection = allocate_introduction_points(
+        ips_per_instance, [weight for _, weight in instances],
+        max_introduction_points)
 
     # intro_selection now lists the count/number of IPs to select from each
     # instance. We now sample the determined number of IPs from the IPs
     # available for each instance.
     choosen_intro_points = []
-    for count, intros in zip(intro_selection, available_introduction_points):
-        choosen_intro_points.extend(random.sample(intros, count))
+    for count, (intros, _) in zip(intro_selection, instances):
+        if published_identifiers:
+            published = [ip for ip in intros
+                         if ip.identifier in published_identifiers]
+            kept = published[:count]
+            new = [ip for ip in intros
+                   if ip.identifier not in published_identifiers]
+            choosen_intro_points.extend(kept)
+            choosen_intro_points.extend(rng.sample(new, count - len(kept)))
+        else:
+            choosen_intro_points.extend(rng.sample(intros, count))
 
     # Shuffle choosen IP's to try reveal less information about which
     # instances are online and have introduction points included.
-    random.shuffle(choosen_intro_points)
+    rng.shuffle(choosen_intro_points)
 
     return choosen_intro_points
 
 
+def partition_introduction_points(available_introduction_points,
+                                  num_partitions, assignment=None):
+    """
+    Split the introduction points of each instance into disjoint partitions
+
+    Each instance's introduction points are spread as evenly as possible
+    across the partitions. Introduction points listed in `assignment`, a
+    dict of identifier -> partition index, stay in that partition unless it
+    already holds its share of the instance's introduction points.
+
+    Return a list with a list of introduction points for each instance in
+    each partition, in the same order as `available_introduction_points`.
+    """
+    assignment = assignment or {}
+    partitions = [[] for _ in range(num_partitions)]
+    partition_sizes = [0] * num_partitions
+
+    for intros in available_introduction_points:
+        shares = [[] for _ in range(num_partitions)]
+        max_share = -(-len(intros) // num_partitions)
+
+        unassigned = []
+        for ip in intros:
+            index = assignment.get(ip.identifier)
+            if index is not None and len(shares[index]) < max_share:
+                shares[index].append(ip)
+            else:
+                unassigned.append(ip)
+
+        # Give the remaining introduction points to the partitions with the
+        # fewest introduction points
+        for ip in unassigned:
+            index = min(range(num_partitions),
+                        key=lambda i: (len(shares[i]),
+                                       partition_sizes[i] + len(shares[i])))
+            shares[index].append(ip)
+
+        for index, share in enumerate(shares):
+            partitions[index].append(share)
+            partition_sizes[index] += len(share)
+
+    return partitions
+
+
+class DescriptorTemplate(object):
+    """
+    Parts of a service descriptor which are fixed for the lifetime of a
+    service key.
+
+    Computing the public key block, permanent ID and onion address once
+    leaves only the time dependent fields and the signature to be
+    generated for each published descriptor.
+    """
+    __slots__ = ('permanent_key_block', 'permanent_id', 'onion_address')
+
+    def __init__(self, permanent_key):
+        self.permanent_key_block = make_public_key_block(permanent_key)
+        self.permanent_id = util.calc_permanent_id(permanent_key)
+        self.onion_address = util.calc_onion_address(permanent_key)
+
+
 def generate_service_descriptor(permanent_key, introduction_point_list=None,
-                                replica=0, timestamp=None, deviation=0):
+                                replica=0, timestamp=None, deviation=0,
+                                template=None):
     """
     High-level interface for generating a signed HS descriptor
+
+    The static descriptor fields are taken from `template` if it is
+    provided, otherwise they are calculated from `permanent_key`.
     """
 
     if not timestamp:
         timestamp = datetime.datetime.utcnow()
     unix_timestamp = int(timestamp.strftime("%s"))
 
-    permanent_key_block = make_public_key_block(permanent_key)
-    permanent_id = util.calc_permanent_id(permanent_key)
+    if not template:
+        template = DescriptorTemplate(permanent_key)
 
     # Calculate the current secret-id-part for this hidden service
     # Deviation allows the generation of a descriptor for a different time
     # period.
-    time_period = (util.get_time_period(unix_timestamp, permanent_id)
+    time_period = (util.get_time_period(unix_timestamp, template.permanent_id)
                    + int(deviation))
 
     secret_id_part = util.calc_secret_id_part(time_period, None, replica)
-    descriptor_id = util.calc_descriptor_id(permanent_id, secret_id_part)
+    descriptor_id = util.calc_descriptor_id(template.permanent_id,
+                                            secret_id_part)
 
     if not introduction_point_list:
-        onion_address = util.calc_onion_address(permanent_key)
         raise ValueError("No introduction points for service %s.onion." %
-                         onion_address)
+                         template.onion_address)
 
     # Generate the introduction point section of the descriptor
     intro_section = make_introduction_points_part(
@@ -104,7 +238,7 @@ def generate_service_descriptor(permanent_key, introduction_point_list=None,
 
     unsigned_descriptor = generate_hs_descriptor_raw(
         desc_id_base32=util.base32_encode_str(descriptor_id),
-        permanent_key_block=permanent_key_block,
+        permanent_key_block=template.permanent_key_block,
         secret_id_part_base32=util.base32_encode_str(secret_id_part),
         publication_time=util.rounded_timestamp(timestamp),
         introduction_points_part=intro_section
@@ -114,6 +248,20 @@ def generate_service_descriptor(permanent_key, introduction_point_list=None,
     return signed_descriptor
 
 
+def get_descriptor_id(permanent_id, replica=0, timestamp=None, deviation=0):
+    """
+    Calculate the descriptor ID of a service for a replica and time period
+    """
+    if not timestamp:
+        timestamp = datetime.datetime.utcnow()
+    unix_timestamp = int(timestamp.strftime("%s"))
+
+    time_period = (util.get_time_period(unix_timestamp, permanent_id)
+                   + int(deviation))
+    secret_id_part = util.calc_secret_id_part(time_period, None, replica)
+    return util.calc_descriptor_id(permanent_id, secret_id_part)
+
+
 def generate_hs_descriptor_raw(desc_id_base32, permanent_key_block,
                                secret_id_part_base32, publication_time,
                                introduction_points_part):
@@ -224,17 +372,30 @@ def sign_descriptor(descriptor, service_key):
     return descriptor + signature_with_headers
 
 
-def descriptor_received(descriptor_content):
+def parse_descriptor(descriptor_content):
     """
-    Process onion service descriptors retrieved from the HSDir system or
-    received directly over the metadata channel.
+    Parse and validate a received onion service descriptor
+
+    This does not modify any instance state and can run on a worker thread.
+    Returns a ParsedDescriptor, or None if the descriptor was invalid.
     """
+    if not isinstance(descriptor_content, bytes):
+        descriptor_content = descriptor_content.encode('utf-8')
+
+    # Skip parsing descriptors which are byte-identical to a descriptor
+    # which was already processed. Only the received time needs updating.
+    descriptor_digest = hashlib.sha1(descriptor_content).digest()
+    onion_address = received_descriptor_cache.get(descriptor_digest)
+    if onion_address:
+        return ParsedDescriptor(onion_address)
 
+    started = time.time()
     try:
         parsed_descriptor = stem.descriptor.hidden_service_descriptor.\
             HiddenServiceDescriptor(descriptor_content, validate=True)
     except ValueError:
         logger.exception("Received an invalid service descriptor.")
+        metrics.descriptor_parse_seconds.observe(time.time() - started)
         return None
 
     # Ensure the received descriptor matches the requested descriptor
@@ -242,33 +403,193 @@ def descriptor_received(descriptor_content):
         parsed_descriptor.permanent_key)
     descriptor_onion_address = util.calc_onion_address(permanent_key)
 
-    # Find the HS instance for this descriptor
-    for service in config.services:
-        for instance in service.instances:
-            if instance.onion_address == descriptor_onion_address:
-                # Update the descriptor and exit
-                instance.update_descriptor(parsed_descriptor)
-                return None
+    # Decode the introduction points for each instance with this address,
+    # decrypting them if the instance uses client authorization.
+    introduction_points = {}
+    decoded = True
+    for instance in config.services.get_instances(descriptor_onion_address):
+        try:
+            introduction_points[instance] = \
+                instance.decode_introduction_points(parsed_descriptor)
+        except (ValueError,
+                stem.descriptor.hidden_service_descriptor.DecryptionFailure):
+            logger.exception("Unable to decode the introduction points for "
+                             "instance %s.onion.", descriptor_onion_address)
+            decoded = False
+
+    # Only skip future copies of this descriptor if it was fully processed,
+    # it may be decodable once the authentication cookie is corrected.
+    if decoded:
+        received_descriptor_cache.set(descriptor_digest,
+                                      descriptor_onion_address)
+    metrics.descriptor_parse_seconds.observe(time.time() - started)
+    return ParsedDescriptor(descriptor_onion_address, parsed_descriptor,
+                            introduction_points, descriptor_content)
+
+
+def forget_received_descriptors(onion_address):
+    """
+    Parse the next descriptors received for an onion address in full
+
+    Must be called when an instance is added for the address or its
+    authentication cookie changes, as the cached descriptors were only
+    decoded for the instances which existed when they were received.
+    """
+    received_descriptor_cache.discard_values(onion_address)
+
+
+def apply_descriptor(parsed):
+    """
+    Update the instances matching a parsed descriptor
+
+    Instance state is only modified here, on the thread which owns it.
+    """
+    instances = config.services.get_instances(parsed.onion_address)
+    if instances:
+        state.state_store.changed()
+
+    if not parsed.descriptor:
+        logger.debug("Received an unchanged descriptor for %s.onion.",
+                     parsed.onion_address)
+        for instance in instances:
+            # Instances added since the descriptor was parsed do not hold
+            # it and must wait for it to be parsed in full
+            if instance.timestamp:
+                instance.received = datetime.datetime.utcnow()
+        return None
+
+    # Update the HS instances for this descriptor. The same instance may be
+    # used by more than one service.
+    for instance in instances:
+        if instance in parsed.introduction_points:
+            instance.update_descriptor(parsed.descriptor,
+                                       parsed.introduction_points[instance])
+    if instances:
+        return None
 
     # No matching service instance was found for the descriptor
     logger.debug("Received a descriptor for an unknown service:\n%s",
-                 descriptor_content.decode('utf-8'))
+                 parsed.descriptor_content.decode('utf-8'))
     logger.warning("Received a descriptor with address %s.onion that "
                    "did not match any configured service instances.",
-                   descriptor_onion_address)
+                   parsed.onion_address)
 
     return None
 
 
-def upload_descriptor(controller, signed_descriptor, hsdirs=None):
+def descriptor_received(descriptor_content):
     """
-    Upload descriptor via the Tor control port
+    Process onion service descriptors retrieved from the HSDir system or
+    received directly over the metadata channel.
+    """
+    parsed = parse_descriptor(descriptor_content)
+    if parsed:
+        apply_descriptor(parsed)
+    return None
 
-    If no HSDir's are specified, Tor will upload to what it thinks are the
-    responsible directories
+
+class ParsedDescriptor(object):
     """
-    logger.debug("Beginning service descriptor upload.")
+    Result of parsing a received descriptor on a worker thread
+
+    `descriptor` is None when the content matched an already processed
+    descriptor.
+    """
+    __slots__ = ('onion_address', 'descriptor', 'introduction_points',
+                 'descriptor_content')
+
+    def __init__(self, onion_address, descriptor=None,
+                 introduction_points=None, descriptor_content=None):
+        self.onion_address = onion_address
+        self.descriptor = descriptor
+        self.introduction_points = introduction_points or {}
+        self.descriptor_content = descriptor_content
 
+
+class DescriptorProcessor(object):
+    """
+    Parse received descriptors on a bounded pool of worker threads.
+
+    Descriptor parsing, signature validation and introduction point
+    decryption run on the workers, so the stem event thread is never blocked
+    by them. The resulting instance updates are applied when the owner
+    thread calls `process_results()`. If `on_result` is given, it is called
+    from the worker thread each time a result is ready. If `on_processed`
+    is given, it is called on the owner thread with the fetched onion
+    address of each submitted descriptor once it has been applied, or
+    rejected as invalid.
+    """
+
+    def __init__(self, num_workers=1, max_queued=1024, on_result=None,
+                 on_processed=None):
+        self._input = queue.Queue(maxsize=max_queued)
+        self._results = queue.Queue()
+        self.on_result = on_result
+        self.on_processed = on_processed
+
+        self._workers = []
+        for _ in range(num_workers):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _worker(self):
+        while True:
+            descriptor_content, onion_address = self._input.get()
+            parsed = None
+            try:
+                parsed = parse_descriptor(descriptor_content)
+            except Exception:
+                logger.error("Unexpected exception parsing a descriptor:",
+                             exc_info=True)
+            if parsed or onion_address:
+                self._results.put((onion_address, parsed))
+                if self.on_result:
+                    self.on_result()
+
+    def _processed(self, onion_address):
+        if onion_address and self.on_processed:
+            self.on_processed(onion_address)
+
+    def submit(self, descriptor_content, onion_address=None):
+        """
+        Queue received descriptor content for parsing without blocking
+
+        `onion_address` is the address of the instance the descriptor was
+        fetched for, if known.
+        """
+        if not self._workers:
+            descriptor_received(descriptor_content)
+            self._processed(onion_address)
+            return
+
+        try:
+            self._input.put_nowait((descriptor_content, onion_address))
+        except queue.Full:
+            # The descriptor will be fetched again in a later refresh
+            logger.warning("Descriptor parsing queue is full, dropping a "
+                           "received descriptor.")
+            self._processed(onion_address)
+
+    def process_results(self):
+        """
+        Apply all parsed descriptors to their instances
+        """
+        while True:
+            try:
+                onion_address, parsed = self._results.get_nowait()
+            except queue.Empty:
+                return
+            if parsed:
+                apply_descriptor(parsed)
+            self._processed(onion_address)
+
+
+def _hspost_message(signed_descriptor, hsdirs=None):
+    """
+    Format a HSPOST command, targeting the given HSDirs if any
+    """
     # Provide server fingerprints to control command if HSDirs are specified.
     if hsdirs:
         server_args = ' '.join([("SERVER={}".format(hsdir))
@@ -277,9 +598,13 @@ def upload_descriptor(controller, signed_descriptor, hsdirs=None):
         server_args = ""
 
     # Stem will insert the leading + and trailing '\r\n.\r\n'
-    response = controller.msg("HSPOST %s\n%s" %
-                              (server_args, signed_descriptor))
+    return "HSPOST %s\n%s" % (server_args, signed_descriptor)
 
+
+def _check_hspost_response(response):
+    """
+    Raise an exception if Tor rejected a HSPOST command
+    """
     (response_code, divider, response_content) = response.content()[0]
     if not response.is_ok():
         if response_code == "552":
@@ -288,3 +613,126 @@ def upload_descriptor(controller, signed_descriptor, hsdirs=None):
             raise stem.ProtocolError("HSPOST returned unexpected response "
                                      "code: %s\n%s" % (response_code,
                                                        response_content))
+
+
+def upload_descriptor(controller, signed_descriptor, hsdirs=None):
+    """
+    Upload descriptor via the Tor control port
+
+    If no HSDir's are specified, Tor will upload to what it thinks are the
+    responsible directories
+    """
+    logger.debug("Beginning service descriptor upload.")
+
+    response = controller.msg(_hspost_message(signed_descriptor, hsdirs))
+    _check_hspost_response(response)
+
+
+class UploadConnection(object):
+    """
+    Separate Tor control connection used to pipeline HSPOST commands.
+
+    The connection never subscribes to events, so every line Tor sends on
+    it is a reply to one of our commands, in the order they were sent. All
+    of a batch's HSPOST commands are written before the first reply is
+    read. If Tor does not reply within HSPOST_TIMEOUT, the connection is
+    closed rather than reused, so a late reply can never be matched to a
+    later command. It is opened again for the next batch.
+    """
+
+    def __init__(self, address, port, password=None):
+        self.address = address
+        self.port = port
+        self.password = password
+        self._control_socket = None
+
+    def _connect(self):
+        control_socket = stem.socket.ControlPort(self.address, self.port)
+        try:
+            stem.connection.authenticate(control_socket,
+                                         password=self.password)
+        except stem.connection.AuthenticationFailure:
+            control_socket.close()
+            raise
+        # Bound how long a send or a reply may take
+        control_socket._socket.settimeout(config.HSPOST_TIMEOUT)
+        self._control_socket = control_socket
+
+    def close(self):
+        if self._control_socket:
+            self._control_socket.close()
+            self._control_socket = None
+
+    def upload(self, uploads):
+        """
+        Pipeline a HSPOST command for each (signed descriptor, HSDirs) tuple
+
+        Returns a list with None for each successful upload, or the
+        stem.ControllerError for each failed upload. Raises stem.SocketError
+        or stem.connection.AuthenticationFailure if the connection cannot be
+        opened.
+        """
+        if not self._control_socket:
+            self._connect()
+
+        results = []
+        num_sent = 0
+        try:
+            for signed_descriptor, hsdirs in uploads:
+                self._control_socket.send(
+                    _hspost_message(signed_descriptor, hsdirs))
+                num_sent += 1
+
+            for _ in range(num_sent):
+                response = self._control_socket.recv()
+                try:
+                    _check_hspost_response(response)
+                except stem.ControllerError as exc:
+                    results.append(exc)
+                else:
+                    results.append(None)
+        except (stem.SocketError, stem.ProtocolError) as exc:
+            # A timeout or malformed reply leaves replies unaccounted for,
+            # so the connection can no longer be trusted
+            logger.warning("Control connection for uploads failed: %s", exc)
+            self.close()
+            results.extend([exc] * (len(uploads) - len(results)))
+        return results
+
+
+# Dedicated control connection for uploads, set up by the manager
+upload_connection = None
+
+
+def upload_descriptors(controller, uploads):
+    """
+    Upload several descriptors via the Tor control port
+
+    `uploads` is a list of (signed descriptor, HSDirs) tuples. The HSPOST
+    commands are pipelined on the dedicated upload connection if there is
+    one. Otherwise, or if it cannot be opened, each command is sent with
+    `controller.msg()`, which waits for Tor's reply before the next command.
+
+    Returns a list with None for each successful upload, or the
+    stem.ControllerError for each failed upload.
+    """
+    logger.debug("Beginning upload of %d service descriptors.", len(uploads))
+
+    if upload_connection:
+        try:
+            return upload_connection.upload(uploads)
+        except (stem.SocketError,
+                stem.connection.AuthenticationFailure) as exc:
+            logger.warning("Unable to open a control connection for "
+                           "uploads, uploading descriptors one at a time: "
+                           "%s", exc)
+
+    results = []
+    for signed_descriptor, hsdirs in uploads:
+        try:
+            upload_descriptor(controller, signed_descriptor, hsdirs)
+        except stem.ControllerError as exc:
+            results.append(exc)
+        else:
+            results.append(None)
+    return results
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 from builtins import str, object
 
+import stem
+
 from onionbalance import log
 from onionbalance import descriptor
+from onionbalance import instance
+from onionbalance import consensus
+from onionbalance import upload
 
 logger = log.get_logger()
 
@@ -13,6 +18,22 @@ class EventHandler(object):
     Handles asynchronous Tor events.
     """
 
+    def __init__(self, descriptor_processor=None):
+        # Received descriptors are parsed off the stem event thread
+        if not descriptor_processor:
+            descriptor_processor = descriptor.DescriptorProcessor(
+                num_workers=0)
+        self.descriptor_processor = descriptor_processor
+
+    @staticmethod
+    def new_consensus(consensus_event):
+        """
+        Update the HSDir ring from NEWCONSENSUS events
+        """
+        logger.debug("Received a new consensus with %d router statuses.",
+                     len(consensus_event.desc))
+        consensus.hsdir_ring.update(consensus_event.desc)
+
     @staticmethod
     def new_desc(desc_event):
         """
@@ -20,15 +41,49 @@ class EventHandler(object):
         """
         logger.debug("Received new HS_DESC event: %s", str(desc_event))
 
-    @staticmethod
-    def new_desc_content(desc_content_event):
+        # pylint: disable=no-member
+        if desc_event.action == stem.HSDescAction.UPLOAD:
+            upload.upload_tracker.upload_started(
+                desc_event.descriptor_id, desc_event.directory_fingerprint)
+
+        elif desc_event.action == stem.HSDescAction.UPLOADED:
+            upload.upload_tracker.upload_finished(
+                desc_event.directory_fingerprint, succeeded=True)
+
+        elif desc_event.action == stem.HSDescAction.FAILED:
+            # Failed uploads are reported without a descriptor ID. Failed
+            # fetches always carry one, even when the request is no longer
+            # outstanding, and must not fail an unrelated upload.
+            if desc_event.descriptor_id in (None, '', 'UNKNOWN'):
+                upload.upload_tracker.upload_finished(
+                    desc_event.directory_fingerprint, succeeded=False,
+                    reason=desc_event.reason)
+                return
+
+            # A failed fetch finishes the outstanding request for the
+            # instance
+            onion_address = instance.fetch_tracker.response_received(
+                [desc_event.descriptor_id, desc_event.address],
+                succeeded=False)
+            if onion_address:
+                logger.warning("No descriptor received for instance "
+                               "%s.onion from HSDir %s (%s), the instance may "
+                               "be offline.", onion_address,
+                               desc_event.directory_fingerprint,
+                               desc_event.reason)
+            else:
+                logger.debug("Ignoring a failed fetch of descriptor ID %s "
+                             "which is no longer outstanding.",
+                             desc_event.descriptor_id)
+
+    def new_desc_content(self, desc_content_event):
         """
         Parse HS_DESC_CONTENT response events for descriptor content
 
         Update the HS instance object with the data from the new descriptor.
         """
-        logger.debug("Received new HS_DESC_CONTENT event for %s.onion",
-                     desc_content_event.address)
+        logger.debug("Received new HS_DESC_CONTENT event for descriptor "
+                     "ID %s", desc_content_event.descriptor_id)
 
         #  Check that the HSDir returned a descriptor that is not empty
         descriptor_text = str(desc_content_event.descriptor).encode('utf-8')
@@ -37,11 +92,14 @@ class EventHandler(object):
         # CRLF lines when they do not have a matching descriptor. Using
         # len() < 5 should ensure all empty HS_DESC_CONTENT events are matched.
         if len(descriptor_text) < 5:
-            logger.debug("Empty descriptor received for %s.onion",
-                         desc_content_event.address)
+            logger.debug("Empty descriptor received for descriptor ID %s",
+                         desc_content_event.descriptor_id)
             return None
 
-        # Send content to callback function which will process the descriptor
-        descriptor.descriptor_received(descriptor_text)
+        onion_address = instance.fetch_tracker.response_received(
+            [desc_content_event.descriptor_id, desc_content_event.address])
+
+        # Queue the content to be parsed by the descriptor processor
+        self.descriptor_processor.submit(descriptor_text, onion_address)
 
         return None
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Single threaded event loop which runs timers, socket handlers and events
+posted from other threads.
+"""
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import queue
+import select
+import signal
+import time
+
+from onionbalance import log
+from onionbalance import metrics
+
+logger = log.get_logger()
+
+
+class Timer(object):
+    """
+    A callback scheduled on the event loop, optionally repeating
+    """
+    __slots__ = ('deadline', 'callback', 'interval', 'cancelled')
+
+    def __init__(self, deadline, callback, interval=None):
+        self.deadline = deadline
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    """
+    Run all work on one thread, sleeping until the next timer or deadline
+    is due, a watched socket is ready or another thread posts an event.
+
+    Other threads, such as the stem event thread and the descriptor parsing
+    workers, must only interact with the loop through `call_soon_threadsafe`
+    so that all state is modified on the loop's thread.
+
+    IO handlers provide `readers()` and `writers()` returning the sockets
+    to watch, `handle_io(readable, writable)` and `timeout()` returning how
+    long the handler can wait, or None. Deadline sources are pairs of a
+    function returning the time the source is next due, or None, and a
+    function to run once it is due.
+    """
+
+    def __init__(self):
+        # Heap of (deadline, sequence number, Timer)
+        self._timers = []
+        self._sequence = itertools.count()
+
+        self._io_handlers = []
+        self._deadline_sources = []
+
+        # Callbacks posted from other threads and the pipe used to wake the
+        # loop when one is posted
+        self._events = queue.Queue()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        # Callbacks for signals and the signals which have been received
+        # but not yet handled
+        self._signal_handlers = {}
+        self._pending_signals = collections.deque()
+
+        self._running = False
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except OSError as exc:
+            # The pipe is full so the loop will wake up anyway
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def call_at(self, deadline, callback, interval=None):
+        """
+        Run `callback` at the unix time `deadline`, and then every
+        `interval` seconds if an interval is given
+        """
+        timer = Timer(deadline, callback, interval)
+        heapq.heappush(self._timers, (deadline, next(self._sequence), timer))
+        return timer
+
+    def call_later(self, delay, callback):
+        return self.call_at(time.time() + delay, callback)
+
+    def call_every(self, interval, callback, delay=None):
+        """
+        Run `callback` every `interval` seconds, first after `delay`
+        seconds or after one interval
+        """
+        if delay is None:
+            delay = interval
+        return self.call_at(time.time() + delay, callback, interval)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Run `callback` on the loop thread as soon as possible. This is the
+        only method which may be called from other threads.
+        """
+        self._events.put((callback, args))
+        self._wakeup()
+
+    def add_signal_handler(self, signum, callback):
+        """
+        Run `callback` on the loop thread when the process receives the
+        signal `signum`
+        """
+        self._signal_handlers[signum] = callback
+        signal.signal(signum, self._handle_signal)
+
+    def _handle_signal(self, signum, frame):
+        # The signal may interrupt the loop while it holds a lock, so only
+        # record the signal and wake up the loop
+        self._pending_signals.append(signum)
+        self._wakeup()
+
+    def add_io_handler(self, handler):
+        self._io_handlers.append(handler)
+
+    def add_deadline_source(self, next_deadline, run):
+        self._deadline_sources.append((next_deadline, run))
+
+    def stop(self):
+        self._running = False
+
+    def _run_callback(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            logger.error("Unexpected exception:", exc_info=True)
+
+    def _run_timers(self, now):
+        while self._timers and self._timers[0][0] <= now:
+            deadline, _, timer = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+
+            metrics.main_loop_lag_seconds.observe(now - deadline)
+            self._run_callback(timer.callback)
+
+            if timer.interval and not timer.cancelled:
+                # Keep repeating timers on their original cadence
+                timer.deadline = max(deadline + timer.interval, now)
+                heapq.heappush(self._timers, (timer.deadline,
+                                              next(self._sequence), timer))
+
+    def _run_deadline_sources(self, now):
+        for next_deadline, run in self._deadline_sources:
+            deadline = next_deadline()
+            if deadline is not None and deadline <= now:
+                metrics.main_loop_lag_seconds.observe(now - deadline)
+                self._run_callback(run)
+
+    def _run_events(self):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except OSError as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+        while self._pending_signals:
+            signum = self._pending_signals.popleft()
+            self._run_callback(self._signal_handlers[signum])
+
+        while True:
+            try:
+                callback, args = self._events.get_nowait()
+            except queue.Empty:
+                return
+            self._run_callback(callback, *args)
+
+    def _next_timeout(self, now):
+        """
+        Return how long to wait for IO, or None to wait until an event
+        """
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+
+        deadlines = [self._timers[0][0]] if self._timers else []
+        for next_deadline, _ in self._deadline_sources:
+            deadline = next_deadline()
+            if deadline is not None:
+                deadlines.append(deadline)
+        for handler in self._io_handlers:
+            timeout = handler.timeout()
+            if timeout is not None:
+                deadlines.append(now + timeout)
+
+        if not deadlines:
+            return None
+        return max(min(deadlines) - now, 0)
+
+    def run_once(self):
+        """
+        Wait for and handle one round of timers, events and IO
+        """
+        now = time.time()
+        timeout = self._next_timeout(now)
+
+        readers = [self._wakeup_read]
+        writers = []
+        for handler in self._io_handlers:
+            readers.extend(handler.readers())
+            writers.extend(handler.writers())
+
+        try:
+            readable, writable, _ = select.select(readers, writers, [],
+                                                  timeout)
+        except (select.error, OSError) as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            readable, writable = [], []
+
+        if self._wakeup_read in readable:
+            self._run_events()
+
+        for handler in self._io_handlers:
+            self._run_callback(handler.handle_io, readable, writable)
+
+        now = time.time()
+        self._run_timers(now)
+        self._run_deadline_sources(now)
+
+    def run_forever(self):
+        self._running = True
+        while self._running:
+            self.run_once()
@@ -1,29 +1,219 @@
 # -*- coding: utf-8 -*-
 import datetime
 import time
+import threading
+import random
+import base64
+import hashlib
+import os
 
 import stem.control
+import yaml
 
 from onionbalance import log
 from onionbalance import config
+from onionbalance import consensus
+from onionbalance import metrics
+from onionbalance import util
 
 logger = log.get_logger()
 
+# Descriptors published longer ago than this are not used
+DESCRIPTOR_MAX_AGE = 4 * 60 * 60
+
 
 def fetch_instance_descriptors(controller):
     """
-    Try fetch fresh descriptors for all HS instances
-    """
-    logger.info("Initiating fetch of descriptors for all service instances.")
+    Try fetch fresh descriptors for all HS instances which are due a fetch
 
-    # Clear Tor descriptor cache before making fetches by sending NEWNYM
-    # pylint: disable=no-member
-    controller.signal(stem.control.Signal.NEWNYM)
-    time.sleep(5)
+    Each instance schedules its own next fetch based on how often its
+    descriptor changes and whether recent fetches have failed. The HSFETCH
+    requests are dispatched without waiting for the HSDirs to respond.
+    Responses are processed by the event handlers as they arrive.
+    """
+    now = time.time()
+    fetch_tracker.start_round()
 
+    due_instances = []
     for service in config.services:
         for instance in service.instances:
-            instance.fetch_descriptor()
+            # Instances may be shared between services, fetch them once
+            if (instance.next_fetch > now or
+                    fetch_tracker.is_outstanding(instance.onion_address)):
+                continue
+            due_instances.append(instance)
+
+    if not due_instances:
+        logger.debug("No instance descriptors are due to be fetched.")
+        return
+
+    logger.info("Initiating fetch of descriptors for %d service instances.",
+                len(due_instances))
+
+    # Fetching from explicitly specified HSDirs bypasses Tor's client-side
+    # HSDir request throttling without a NEWNYM, which would also clear
+    # every other circuit on the management Tor.
+    if not consensus.hsdir_ring:
+        logger.warning("No HSDirs found in the consensus, letting Tor "
+                       "choose which HSDirs to fetch descriptors from.")
+
+    for instance in due_instances:
+        # Shared instances are rescheduled when a fetch of their address
+        # could not be dispatched
+        if (instance.next_fetch > now or
+                fetch_tracker.is_outstanding(instance.onion_address)):
+            continue
+        request_keys = instance.fetch_descriptor()
+        if not request_keys:
+            fetch_tracker.dispatch_failed(instance.onion_address)
+        for request_key in request_keys:
+            fetch_tracker.dispatched(request_key, instance.onion_address)
+
+
+def fetch_completed(onion_address, succeeded):
+    """
+    Reschedule the instances with an onion address once all of the fetches
+    for the address have finished.
+    """
+    for instance in config.services.get_instances(onion_address):
+        instance.fetch_completed(succeeded)
+
+
+class FetchTracker(object):
+    """
+    Track outstanding HSFETCH requests for instance descriptors.
+
+    Each request is outstanding until Tor emits a HS_DESC_CONTENT event
+    with the descriptor or a HS_DESC FAILED event for the request. A
+    refresh round is complete once no requests remain outstanding, so the
+    length of a round is bounded by the slowest HSDir response.
+
+    Requests are keyed by the base32 descriptor ID when fetching from
+    specific HSDirs, or by the onion address when Tor chooses the HSDir.
+    """
+
+    def __init__(self, completed_callback=None):
+        # Map of request key -> (onion address, time HSFETCH was dispatched)
+        self.outstanding = {}
+
+        # Map of onion address -> [number of outstanding requests, whether
+        # any request for the address has succeeded]
+        self._address_requests = {}
+
+        # Called with the onion address and success once all requests for
+        # an address have finished
+        self.completed_callback = completed_callback
+
+        # Time when the current refresh round was started
+        self.round_started = None
+
+        # Events arrive on the stem event thread
+        self._lock = threading.Lock()
+
+    def _remove(self, request_key, succeeded):
+        """
+        Remove an outstanding request, returning the onion address and
+        whether all requests for the address have now finished.
+        """
+        onion_address, dispatched = self.outstanding.pop(request_key)
+        address_requests = self._address_requests[onion_address]
+        address_requests[0] -= 1
+        address_requests[1] = address_requests[1] or succeeded
+        if address_requests[0]:
+            return onion_address, dispatched, None
+
+        del self._address_requests[onion_address]
+        return onion_address, dispatched, address_requests[1]
+
+    def _completed(self, onion_address, succeeded):
+        if succeeded is not None and self.completed_callback:
+            self.completed_callback(onion_address, succeeded)
+
+    def start_round(self):
+        """
+        Begin a new refresh round, expiring requests from earlier rounds
+        which never received a response.
+        """
+        completed = []
+        with self._lock:
+            now = time.time()
+            for request_key, (onion_address, dispatched) in list(
+                    self.outstanding.items()):
+                if now - dispatched > config.FETCH_TIMEOUT:
+                    logger.info("Descriptor fetch for instance %s.onion "
+                                "timed out.", onion_address)
+                    metrics.descriptor_fetches.inc(instance=onion_address,
+                                                   result='timeout')
+                    onion_address, _, succeeded = self._remove(
+                        request_key, succeeded=False)
+                    completed.append((onion_address, succeeded))
+            self.round_started = now
+
+        for onion_address, succeeded in completed:
+            self._completed(onion_address, succeeded)
+
+    def dispatched(self, request_key, onion_address):
+        """
+        Record that a HSFETCH request was sent for an onion address
+        """
+        with self._lock:
+            if request_key not in self.outstanding:
+                self._address_requests.setdefault(onion_address,
+                                                  [0, False])[0] += 1
+            self.outstanding[request_key] = (onion_address, time.time())
+
+    def dispatch_failed(self, onion_address):
+        """
+        Finish a fetch for an onion address for which no request could be
+        dispatched
+        """
+        self._completed(onion_address, succeeded=False)
+
+    def is_outstanding(self, onion_address):
+        with self._lock:
+            return onion_address in self._address_requests
+
+    def round_complete(self):
+        with self._lock:
+            return not self.outstanding
+
+    def response_received(self, request_keys, succeeded=True):
+        """
+        Mark an outstanding fetch as finished
+
+        The first of `request_keys` which matches an outstanding request is
+        used. Returns the onion address of the request, or None if no
+        matching fetch was outstanding.
+        """
+        with self._lock:
+            for request_key in request_keys:
+                if request_key and request_key in self.outstanding:
+                    break
+            else:
+                return None
+
+            onion_address, dispatched, address_succeeded = self._remove(
+                request_key, succeeded)
+            result = "succeeded" if succeeded else "failed"
+            logger.debug("Descriptor fetch for instance %s.onion %s after "
+                         "%.2f seconds.", onion_address, result,
+                         time.time() - dispatched)
+            metrics.descriptor_fetches.inc(instance=onion_address,
+                                           result=result)
+            metrics.descriptor_fetch_seconds.observe(
+                time.time() - dispatched, instance=onion_address)
+
+            if not self.outstanding and self.round_started:
+                logger.info("Finished fetching instance descriptors in "
+                            "%.2f seconds.", time.time() - self.round_started)
+                self.round_started = None
+
+        self._completed(onion_address, address_succeeded)
+        return onion_address
+
+
+# Outstanding descriptor fetches shared by the scheduler and event handlers
+fetch_tracker = FetchTracker(completed_callback=fetch_completed)
 
 
 class Instance(object):
@@ -31,12 +221,27 @@ class Instance(object):
     Instance represents a back-end load balancing hidden service.
     """
 
-    def __init__(self, controller, onion_address, authentication_cookie=None):
+    def __init__(self, controller, onion_address, authentication_cookie=None,
+                 weight=1, load_report=None):
         """
         Initialise an Instance object.
         """
         self.controller = controller
 
+        # Relative share of the master descriptor's introduction points and
+        # the optional path of a load report written by the instance
+        self.weight = weight
+        self.load_report = load_report
+
+        # Whether the last attempt to read the load report succeeded, so a
+        # missing report is only logged when it becomes unavailable
+        self._load_report_available = True
+
+        # Decoded introduction points keyed by the authentication cookie and
+        # the digest of the encoded introduction point section
+        self._introduction_point_cache = util.LRUCache(
+            config.INTRO_POINT_CACHE_SIZE)
+
         # Onion address for the service instance.
         self.onion_address = onion_address
         self.authentication_cookie = authentication_cookie
@@ -47,35 +252,278 @@ class Instance(object):
         # Timestamp when last received a descriptor for this instance
         self.received = None
 
-        # Timestamp of the currently loaded descriptor
+        # Timestamp and raw content of the currently loaded descriptor
         self.timestamp = None
+        self.descriptor_content = None
 
         # Flag this instance with it's introduction points change. A new
         # master descriptor will then be published as the introduction
         # points have changed.
         self.changed_since_published = False
 
+        # Time (unix timestamp) when this instance is next due to be fetched
+        self.next_fetch = 0
+
+        # Number of consecutive fetches which did not return a descriptor
+        self.fetch_failures = 0
+
+        # Whether any fetch for this instance has finished since startup
+        self.fetch_attempted = False
+
+        # Time when a changed descriptor was last seen for this instance and
+        # the estimated interval between the instance's descriptor changes
+        self.last_changed = None
+        self.publish_interval = None
+
     def fetch_descriptor(self):
         """
         Try fetch a fresh descriptor for this service instance from the HSDirs
+
+        When HSDirs are known from the consensus, each descriptor replica is
+        fetched by its descriptor ID from one of the responsible HSDirs.
+        Requests are dispatched without waiting for a response. Returns the
+        keys of the requests which were accepted by Tor.
         """
         logger.debug("Trying to fetch a descriptor for instance %s.onion.",
                      self.onion_address)
+        if not consensus.hsdir_ring:
+            try:
+                self.controller.get_hidden_service_descriptor(
+                    self.onion_address, await_result=False)
+            except stem.ControllerError:
+                logger.exception("Error requesting a descriptor for instance "
+                                 "%s.onion.", self.onion_address)
+                return []
+            else:
+                return [self.onion_address]
+
+        request_keys = []
+        for descriptor_id in self.get_descriptor_ids():
+            responsible_hsdirs = consensus.hsdir_ring.get_responsible_hsdirs(
+                descriptor_id)
+            descriptor_id_base32 = util.base32_encode_str(descriptor_id)
+            hsdir = random.choice(responsible_hsdirs)
+            try:
+                response = self.controller.msg("HSFETCH v2-%s SERVER=%s" %
+                                               (descriptor_id_base32, hsdir))
+            except stem.ControllerError:
+                logger.exception("Error requesting a descriptor for instance "
+                                 "%s.onion.", self.onion_address)
+                continue
+
+            if not response.is_ok():
+                logger.warning("HSFETCH for instance %s.onion returned an "
+                               "unexpected response: %s", self.onion_address,
+                               response)
+            else:
+                request_keys.append(descriptor_id_base32)
+
+        return request_keys
+
+    def fetch_completed(self, succeeded):
+        """
+        Update the fetch failure count and schedule the next fetch once all
+        requests for a fetch of this instance have finished.
+        """
+        self.fetch_attempted = True
+        if succeeded:
+            self.fetch_failures = 0
+        else:
+            self.fetch_failures += 1
+        self.schedule_next_fetch()
+
+    def schedule_next_fetch(self, now=None):
+        """
+        Decide when this instance should next be fetched
+
+        Instances which keep failing are backed off exponentially. Otherwise
+        the instance is fetched shortly after it is next expected to
+        republish its descriptor, based on the observed publish interval.
+        """
+        if not now:
+            now = time.time()
+
+        if self.fetch_failures:
+            interval = config.REFRESH_INTERVAL * 2 ** (self.fetch_failures - 1)
+        elif self.publish_interval and self.last_changed:
+            expected_change = (self.last_changed + self.publish_interval +
+                               config.MIN_REFRESH_INTERVAL)
+            if expected_change > now:
+                interval = expected_change - now
+            else:
+                # Overdue to change, fall back to the default interval
+                interval = config.REFRESH_INTERVAL
+        else:
+            interval = config.REFRESH_INTERVAL
+
+        interval = max(config.MIN_REFRESH_INTERVAL,
+                       min(interval, config.MAX_REFRESH_INTERVAL))
+        self.next_fetch = now + interval
+        logger.debug("Next fetch for instance %s.onion in %d seconds.",
+                     self.onion_address, interval)
+
+    def _descriptor_changed(self, now=None):
+        """
+        Update the estimated publish interval when a changed descriptor is
+        received for this instance.
+        """
+        if not now:
+            now = time.time()
+
+        if self.last_changed:
+            observed_interval = now - self.last_changed
+            if self.publish_interval:
+                # Exponentially weighted moving average of the intervals
+                self.publish_interval = (0.7 * self.publish_interval +
+                                         0.3 * observed_interval)
+            else:
+                self.publish_interval = observed_interval
+        self.last_changed = now
+        self.schedule_next_fetch(now)
+
+    def get_load(self, now=None):
+        """
+        Read the utilisation of this instance from its load report
+
+        The load report is a YAML file with the fraction of CPU in use as
+        `cpu` and/or the number of open rendezvous circuits as
+        `rendezvous_circuits` out of `max_rendezvous_circuits`. Returns the
+        highest utilisation between 0 and 1, or None if no recent report is
+        available.
+        """
+        if not self.load_report:
+            return None
+
+        now = now or time.time()
+        if not os.path.exists(self.load_report):
+            return self._load_report_unavailable("it does not exist")
+        try:
+            if now - os.path.getmtime(self.load_report) > \
+                    config.LOAD_REPORT_MAX_AGE:
+                return self._load_report_unavailable("it is too old")
+            with open(self.load_report, 'r') as handle:
+                report = yaml.safe_load(handle) or {}
+        except (IOError, OSError, yaml.YAMLError) as exc:
+            return self._load_report_unavailable(exc)
+
+        utilisation = []
         try:
-            self.controller.get_hidden_service_descriptor(self.onion_address,
-                                                          await_result=False)
-        except stem.DescriptorUnavailable:
-            # Could not find the descriptor on the HSDir
-            self.received = None
-            logger.warning("No descriptor received for instance %s.onion, "
-                           "the instance may be offline.", self.onion_address)
+            if report.get('cpu') is not None:
+                utilisation.append(float(report['cpu']))
+            if report.get('max_rendezvous_circuits'):
+                utilisation.append(float(report['rendezvous_circuits']) /
+                                   float(report['max_rendezvous_circuits']))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return self._load_report_unavailable("it is invalid")
 
-    def update_descriptor(self, parsed_descriptor):
+        if not self._load_report_available:
+            logger.info("Load report for instance %s.onion is available "
+                        "again.", self.onion_address)
+            self._load_report_available = True
+
+        if not utilisation:
+            return None
+        return min(max(max(utilisation), 0.0), 1.0)
+
+    def _load_report_unavailable(self, reason):
+        """
+        Log that the load report cannot be used, once until it becomes
+        available again
+        """
+        if self._load_report_available:
+            logger.warning("Not using the load report for instance %s.onion, "
+                           "%s.", self.onion_address, reason)
+            self._load_report_available = False
+        return None
+
+    def get_weight(self, now=None):
+        """
+        Weight of this instance when distributing introduction points
+
+        The configured weight is scaled down by the reported load of the
+        instance, but never below LOAD_WEIGHT_FLOOR of the configured
+        weight so a busy instance stays reachable.
+        """
+        load = self.get_load(now)
+        if load is None:
+            return self.weight
+        return self.weight * max(1.0 - load, config.LOAD_WEIGHT_FLOOR)
+
+    def get_state(self, now=None):
+        """
+        Return 'offline' if no descriptor has been received for this
+        instance, 'stale' if its descriptor is too old for its introduction
+        points to be published, or 'online'.
+        """
+        if not self.received:
+            return 'offline'
+
+        # The instance may be offline if no descriptor has been received
+        # for it recently or if the received descriptor's timestamp is
+        # too old
+        now = now or datetime.datetime.utcnow()
+        received_age = (now - self.received).total_seconds()
+        timestamp_age = (now - self.timestamp).total_seconds()
+        if (received_age > config.DESCRIPTOR_UPLOAD_PERIOD or
+                timestamp_age > DESCRIPTOR_MAX_AGE):
+            return 'stale'
+        return 'online'
+
+    def get_descriptor_ids(self, timestamp=None):
+        """
+        Calculate the current descriptor ID for each replica of this instance
+        """
+        if not timestamp:
+            timestamp = time.time()
+        permanent_id = base64.b32decode(self.onion_address, 1)
+        time_period = util.get_time_period(timestamp, permanent_id)
+        return [util.calc_descriptor_id(
+                    permanent_id,
+                    util.calc_secret_id_part(time_period, None, replica))
+                for replica in range(0, config.REPLICAS)]
+
+    @property
+    def authentication_cookie(self):
+        return self._authentication_cookie
+
+    @authentication_cookie.setter
+    def authentication_cookie(self, authentication_cookie):
+        """
+        Set the authentication cookie, discarding introduction points which
+        were decrypted with the previous cookie.
+        """
+        self._authentication_cookie = authentication_cookie
+        self._introduction_point_cache.clear()
+
+    def decode_introduction_points(self, parsed_descriptor):
+        """
+        Parse the introduction point list, decrypting if necessary
+
+        Instances often republish the same introduction points, so the
+        decoded list is reused when the encoded section is unchanged.
+        """
+        authentication_cookie = self.authentication_cookie
+        introduction_points_encoded = (
+            parsed_descriptor.introduction_points_encoded or '')
+        cache_key = (authentication_cookie, hashlib.sha1(
+            introduction_points_encoded.encode('utf-8')).digest())
+
+        introduction_points = self._introduction_point_cache.get(cache_key)
+        if introduction_points is None:
+            introduction_points = parsed_descriptor.introduction_points(
+                authentication_cookie=authentication_cookie
+            )
+            self._introduction_point_cache.set(cache_key,
+                                               introduction_points)
+        return introduction_points
+
+    def update_descriptor(self, parsed_descriptor, introduction_points=None):
         """
         Update introduction points when a new HS descriptor is received
 
         Parse the descriptor content and update the set of introduction
-        points for this HS instance.
+        points for this HS instance. The introduction points may already
+        have been decoded when the descriptor was parsed.
         """
 
         self.received = datetime.datetime.utcnow()
@@ -92,12 +540,13 @@ class Instance(object):
                          self.onion_address)
             return
         else:
+            descriptor_changed = self.timestamp != parsed_descriptor.published
             self.timestamp = parsed_descriptor.published
+            self.descriptor_content = str(parsed_descriptor)
 
-        # Parse the introduction point list, decrypting if necessary
-        introduction_points = parsed_descriptor.introduction_points(
-            authentication_cookie=self.authentication_cookie
-        )
+        if introduction_points is None:
+            introduction_points = self.decode_introduction_points(
+                parsed_descriptor)
 
         # If the new introduction points are different, flag this instance
         # as modified. Compare the set of introduction point identifiers
@@ -108,7 +557,11 @@ class Instance(object):
                         "%s.onion.", self.onion_address)
             self.changed_since_published = True
             self.introduction_points = introduction_points
+            descriptor_changed = True
 
         else:
             logger.debug("Introduction points for instance %s.onion matched "
                          "the cached set.", self.onion_address)
+
+        if descriptor_changed:
+            self._descriptor_changed()
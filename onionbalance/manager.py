@@ -6,37 +6,93 @@ each instance.
 """
 import os
 import signal
+import socket
 import sys
 import argparse
+import functools
 import logging
 
 # import Crypto.PublicKey
 import stem
 from stem.control import Controller, EventType
 from setproctitle import setproctitle  # pylint: disable=no-name-in-module
-import schedule
 
 from onionbalance import log
 from onionbalance import settings
 from onionbalance import config
 from onionbalance import eventhandler
+from onionbalance import consensus
+from onionbalance import descriptor
+from onionbalance import eventloop
+from onionbalance import metrics
 from onionbalance.status import StatusSocket
 
 import onionbalance.service
+import onionbalance.state
 import onionbalance.instance
+import onionbalance.upload
 
 logger = log.get_logger()
 
 
 def handle_sigint_sigterm(signum, frame):
-    """Handle SIGINT (Ctrl-C) and SIGTERM"""
+    """Handle SIGINT (Ctrl-C) and SIGTERM during startup"""
     logger.info("Signal %d received, exiting", signum)
+    onionbalance.service.stop_signing_pool()
     handle_sigint_sigterm.__tor_controller.close()
     handle_sigint_sigterm.__status_socket.close()
     logging.shutdown()
     sys.exit(0)
 
 
+def stop_event_loop(loop, signum):
+    """
+    Handle SIGINT (Ctrl-C) and SIGTERM once the event loop is running
+
+    The loop finishes the work it is doing before it stops, so the state
+    is saved consistently by `shutdown`.
+    """
+    logger.info("Signal %d received, exiting", signum)
+    loop.stop()
+
+
+def shutdown(controller, status_socket):
+    """
+    Save the state and release resources once the event loop has stopped
+    """
+    onionbalance.service.stop_signing_pool()
+    onionbalance.state.state_store.save()
+    if descriptor.upload_connection:
+        descriptor.upload_connection.close()
+    controller.close()
+    status_socket.close()
+    logging.shutdown()
+
+
+def instance_fetch_completed(onion_address, succeeded):
+    """
+    Reschedule the fetched instances
+
+    A fetched descriptor is only passed on to the publish scheduler once
+    the descriptor processor has applied it, so that the first publish of
+    a warming up service includes the instance. Failed fetches have no
+    descriptor to wait for.
+    """
+    onionbalance.instance.fetch_completed(onion_address, succeeded)
+    if not succeeded:
+        onionbalance.service.publish_scheduler.instance_fetched(onion_address)
+
+
+def reload_config(controller, config_file):
+    """
+    Reload the services and instances from the config file on SIGHUP and
+    fetch any new instances straight away
+    """
+    logger.info("Reloading the config file.")
+    if settings.reload_config(controller, config_file):
+        onionbalance.instance.fetch_instance_descriptors(controller)
+
+
 def setup_signal_handler(controller, status_socket):
     handle_sigint_sigterm.__tor_controller = controller
     handle_sigint_sigterm.__status_socket = status_socket
@@ -100,6 +156,15 @@ def main():
 
     status_socket = StatusSocket(config)
 
+    if config.METRICS_PORT:
+        try:
+            metrics.MetricsServer(config.METRICS_ADDRESS,
+                                  int(config.METRICS_PORT))
+        except (socket.error, ValueError) as exc:
+            logger.error("Unable to serve metrics on %s:%s: %s",
+                         config.METRICS_ADDRESS, config.METRICS_PORT, exc)
+            sys.exit(1)
+
     # Create a connection to the Tor control port
     try:
         tor_address = (args.ip or config.TOR_ADDRESS)
@@ -122,6 +187,10 @@ def main():
     else:
         logger.debug("Successfully authenticated to the Tor control port.")
 
+    # HSPOST commands are pipelined on their own control connection
+    descriptor.upload_connection = descriptor.UploadConnection(
+        tor_address, tor_port, password=config.TOR_CONTROL_PASSWORD)
+
     # Disable no-member due to bug with "Instance of 'Enum' has no * member"
     # pylint: disable=no-member
 
@@ -139,27 +208,70 @@ def main():
 
     # Finished parsing all the config file.
 
-    handler = eventhandler.EventHandler()
-    controller.add_event_listener(handler.new_desc,
-                                  EventType.HS_DESC)
-    controller.add_event_listener(handler.new_desc_content,
-                                  EventType.HS_DESC_CONTENT)
-
-    # Schedule descriptor fetch and upload events
-    schedule.every(config.REFRESH_INTERVAL).seconds.do(
-        onionbalance.instance.fetch_instance_descriptors, controller)
-    schedule.every(config.PUBLISH_CHECK_INTERVAL).seconds.do(
-        onionbalance.service.publish_all_descriptors)
-
-    # Run initial fetch of HS instance descriptors
-    schedule.run_all(delay_seconds=30)
-
-    # Begin main loop to poll for HS descriptors
-    while True:
-        try:
-            schedule.run_pending()
-        except Exception:
-            logger.error("Unexpected exception:", exc_info=True)
-        status_socket.listen_with_timeout()
+    # Restore the instance descriptors saved before the last shutdown
+    onionbalance.state.state_store.load()
+
+    # Fork the signing processes once the service keys are loaded
+    onionbalance.service.start_signing_pool(config.SIGNING_WORKERS)
+
+    # All timers, status requests and Tor events are handled on the event
+    # loop's thread
+    loop = eventloop.EventLoop()
+
+    descriptor_processor = descriptor.DescriptorProcessor(
+        num_workers=config.PARSE_WORKERS,
+        max_queued=config.PARSE_QUEUE_SIZE,
+        on_result=lambda: loop.call_soon_threadsafe(
+            descriptor_processor.process_results),
+        on_processed=onionbalance.service.publish_scheduler.instance_fetched)
+
+    # Stem calls the listeners on its event thread, hand the events over
+    # to the event loop
+    handler = eventhandler.EventHandler(descriptor_processor)
+    for listener, event_type in [
+            (handler.new_desc, EventType.HS_DESC),
+            (handler.new_desc_content, EventType.HS_DESC_CONTENT),
+            (handler.new_consensus, EventType.NEWCONSENSUS)]:
+        controller.add_event_listener(
+            functools.partial(loop.call_soon_threadsafe, listener),
+            event_type)
+
+    # Load the responsible HSDirs from the current consensus
+    consensus.hsdir_ring.refresh(controller)
+
+    loop.add_io_handler(status_socket)
+
+    # Schedule descriptor fetch and upload events, starting with an initial
+    # fetch of HS instance descriptors
+    loop.call_every(config.FETCH_CHECK_INTERVAL, functools.partial(
+        onionbalance.instance.fetch_instance_descriptors, controller),
+        delay=0)
+    loop.add_deadline_source(
+        onionbalance.upload.upload_tracker.next_retry_deadline,
+        onionbalance.upload.retry_failed_uploads)
+
+    # Each service is published at its own randomized deadline. The first
+    # publish happens once all of a service's instances have been fetched,
+    # or after WARMUP_TIMEOUT if some instances are slow to respond.
+    for service in config.services:
+        onionbalance.service.publish_scheduler.warm_up(
+            service, config.WARMUP_TIMEOUT)
+    onionbalance.instance.fetch_tracker.completed_callback = \
+        instance_fetch_completed
+    loop.add_deadline_source(
+        onionbalance.service.publish_scheduler.next_deadline,
+        onionbalance.service.publish_scheduler.run_pending)
+    loop.add_deadline_source(onionbalance.state.state_store.next_deadline,
+                             onionbalance.state.state_store.save)
+
+    # Services and instances can be added and removed without a restart
+    loop.add_signal_handler(signal.SIGHUP, functools.partial(
+        reload_config, controller, args.config))
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, functools.partial(
+            stop_event_loop, loop, signum))
+
+    loop.run_forever()
+    shutdown(controller, status_socket)
 
     return 0
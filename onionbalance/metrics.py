@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+In-process metrics exported in the Prometheus/OpenMetrics text format.
+
+Counters and histograms are updated on the hot paths and only hold a few
+numbers per label set. Gauges describing the current state of the services
+and instances are computed when the metrics are scraped.
+"""
+import bisect
+import contextlib
+import threading
+import time
+import datetime
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from onionbalance import log
+from onionbalance import config
+
+logger = log.get_logger()
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        name += "{%s}" % ",".join('%s="%s"' % (label, _escape(label_value))
+                                  for label, label_value in labels)
+    return "%s %s" % (name, repr(float(value)))
+
+
+class Metric(object):
+    """
+    A metric family with a value for each combination of label values
+    """
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labelnames)
+
+    def samples(self):
+        """
+        Return (sample name, labels, value) tuples for all label sets
+        """
+        raise NotImplementedError
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s %s" % (self.name, self.metric_type)]
+        lines.extend(_format_sample(*sample) for sample in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name + '_total', list(zip(self.labelnames, key)), value)
+                for key, value in values]
+
+
+class Gauge(Metric):
+    """
+    A gauge which is either set directly or computed by `collect` when the
+    metrics are scraped. `collect` returns (labels dict, value) tuples.
+    """
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.collect:
+            values = sorted((self._key(labels), value)
+                            for labels, value in self.collect())
+        else:
+            with self._lock:
+                values = sorted(self._values.items())
+        return [(self.name, list(zip(self.labelnames, key)), value)
+                for key, value in values]
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Bucket counts, with the +Inf bucket last, and the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1)
+                counts.append(0.0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observe the time taken by the body of a with statement
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts))
+                            for key, counts in self._values.items())
+
+        samples = []
+        for key, counts in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                samples.append((self.name + '_bucket',
+                                labels + [('le', le)], cumulative))
+            samples.append((self.name + '_count', labels, cumulative))
+            samples.append((self.name + '_sum', labels, counts[-1]))
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+    The set of metrics which are exported
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Render all metrics in the OpenMetrics text format
+        """
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                logger.error("Unable to collect metric %s.", metric.name,
+                             exc_info=True)
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def _instance_intro_points():
+    for service in config.services:
+        for instance in service.instances:
+            yield ({'service': service.onion_address,
+                    'instance': instance.onion_address},
+                   len(instance.introduction_points))
+
+
+def _instance_descriptor_age():
+    now = datetime.datetime.utcnow()
+    for service in config.services:
+        for instance in service.instances:
+            if instance.timestamp:
+                yield ({'service': service.onion_address,
+                        'instance': instance.onion_address},
+                       (now - instance.timestamp).total_seconds())
+
+
+def _service_intro_points():
+    for service in config.services:
+        yield ({'service': service.onion_address},
+               service.intro_point_fanout)
+
+
+# Metrics updated from the fetch, parse, sign and publish code paths
+descriptor_fetches = registry.register(Counter(
+    'onionbalance_descriptor_fetches',
+    "Instance descriptor fetches by result", ('instance', 'result')))
+descriptor_fetch_seconds = registry.register(Histogram(
+    'onionbalance_descriptor_fetch_seconds',
+    "Time for a HSDir to respond to an instance descriptor fetch",
+    ('instance',)))
+descriptor_parse_seconds = registry.register(Histogram(
+    'onionbalance_descriptor_parse_seconds',
+    "Time taken to parse and validate a received instance descriptor"))
+descriptor_sign_seconds = registry.register(Histogram(
+    'onionbalance_descriptor_sign_seconds',
+    "Time taken to sign a batch of master descriptors"))
+publish_seconds = registry.register(Histogram(
+    'onionbalance_publish_seconds',
+    "Time taken to select, sign and upload a service's master descriptors",
+    ('service',)))
+hspost_commands = registry.register(Counter(
+    'onionbalance_hspost_commands',
+    "HSPOST commands sent to Tor by result", ('service', 'result')))
+hsdir_uploads = registry.register(Counter(
+    'onionbalance_hsdir_uploads',
+    "Master descriptor uploads reported by HSDirs by result",
+    ('service', 'result')))
+main_loop_lag_seconds = registry.register(Histogram(
+    'onionbalance_main_loop_lag_seconds',
+    "Delay between the deadline of scheduled work and when the event loop "
+    "ran it"))
+
+# Gauges computed from the state of the services when scraped
+registry.register(Gauge(
+    'onionbalance_instance_intro_points',
+    "Introduction points in the latest descriptor of each instance",
+    ('service', 'instance'), collect=_instance_intro_points))
+registry.register(Gauge(
+    'onionbalance_instance_descriptor_age_seconds',
+    "Age of the latest descriptor of each instance",
+    ('service', 'instance'), collect=_instance_descriptor_age))
+registry.register(Gauge(
+    'onionbalance_service_intro_points',
+    "Distinct introduction points in a service's master descriptors",
+    ('service',), collect=_service_intro_points))
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request from %s: %s", self.client_address[0],
+                     format % args)
+
+
+class MetricsServer(object):
+    """
+    Serve the metrics over HTTP on a local TCP port from a daemon thread
+    """
+
+    def __init__(self, address, port):
+        self._server = HTTPServer((address, port), _MetricsRequestHandler)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Serving metrics on %s:%d.",
+                    *self._server.server_address[:2])
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
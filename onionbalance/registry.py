@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the onion services managed by onionbalance and their instances.
+"""
+from onionbalance import log
+
+logger = log.get_logger()
+
+
+class ServiceRegistry(object):
+    """
+    List of managed services with an index of instances by onion address.
+
+    The same instance address may be configured for several services, in
+    which case each service has its own Instance object for the address.
+    """
+
+    def __init__(self):
+        self._services = []
+
+        # Map of instance onion address -> list of Instance objects
+        self._instances = {}
+
+    def __iter__(self):
+        return iter(self._services)
+
+    def __len__(self):
+        return len(self._services)
+
+    def __getitem__(self, index):
+        return self._services[index]
+
+    def _index_instance(self, instance):
+        self._instances.setdefault(instance.onion_address, []).append(instance)
+
+    def _unindex_instance(self, instance):
+        instances = self._instances.get(instance.onion_address, [])
+        if instance in instances:
+            instances.remove(instance)
+        if not instances:
+            self._instances.pop(instance.onion_address, None)
+
+    def append(self, service):
+        """
+        Add a service and its instances to the registry
+        """
+        self._services.append(service)
+        for instance in service.instances:
+            self._index_instance(instance)
+
+    def remove(self, service):
+        """
+        Remove a service and its instances from the registry
+        """
+        self._services.remove(service)
+        for instance in service.instances:
+            self._unindex_instance(instance)
+
+    def add_instance(self, service, instance):
+        """
+        Add an instance to a registered service
+        """
+        service.instances.append(instance)
+        self._index_instance(instance)
+
+    def remove_instance(self, service, instance):
+        """
+        Remove an instance from a registered service
+        """
+        service.instances.remove(instance)
+        self._unindex_instance(instance)
+
+    def get_instances(self, onion_address):
+        """
+        Return all instances configured with an onion address
+        """
+        return list(self._instances.get(onion_address, []))
@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 import datetime
 import time
-import base64
+import multiprocessing
+import heapq
+import itertools
+import random
 
 import Crypto.PublicKey.RSA
-import stem
 
 from onionbalance import descriptor
+from onionbalance import consensus
+from onionbalance import metrics
+from onionbalance import state
+from onionbalance import upload
 from onionbalance import util
 from onionbalance import log
 from onionbalance import config
@@ -16,16 +22,371 @@ logger = log.get_logger()
 
 def publish_all_descriptors():
     """
-    Called periodically to upload new super-descriptors if needed
+    Upload new super-descriptors for all services if needed
 
-    .. todo:: Publishing descriptors for different services at the same time
-              will leak that they are related. Descriptors should
-              be published individually at a random interval to avoid
-              correlation.
+    Services are normally published individually by the publish scheduler,
+    as publishing descriptors for different services at the same time will
+    leak that they are related.
     """
     logger.debug("Checking if any master descriptors should be published.")
+    publish_descriptors(config.services)
+
+
+def publish_descriptors(services):
+    """
+    Upload new super-descriptors for a list of services if needed
+
+    The descriptors for all of the services are signed together so that
+    signing can be spread across the signing pool, then uploaded per service.
+    """
+    started = time.time()
+    service_jobs = [(service, service.prepare_publish())
+                    for service in services]
+    sign_descriptors([job for _, jobs in service_jobs for job in jobs])
+    for service, jobs in service_jobs:
+        if jobs:
+            service.upload_descriptors(jobs)
+
+    # Services published together share the time taken to sign and upload
+    for service, jobs in service_jobs:
+        if jobs:
+            metrics.publish_seconds.observe(time.time() - started,
+                                            service=service.onion_address)
+
+
+class PublishScheduler(object):
+    """
+    Check each service for publishing at its own randomized deadline.
+
+    Deadlines are kept in a heap. After each check the next deadline for a
+    service is drawn uniformly from PUBLISH_CHECK_INTERVAL +/- 50%, which
+    keeps the average check interval while spreading the signing and
+    upload work for different services evenly over time.
+    """
+
+    JITTER = 0.5
+
+    def __init__(self):
+        # Heap of [deadline, sequence number, service] entries. Removed
+        # services have their entry's service set to None.
+        self._heap = []
+        self._entries = {}
+        self._sequence = itertools.count()
+
+        # Services which have not been published since startup, mapped to
+        # the addresses of their instances which are waiting to be fetched,
+        # and an index of the warming up services by instance address
+        self._warming_up = {}
+        self._warming_up_by_address = {}
+
+        # Number of services which were due in the last run and how late
+        # (in seconds) services were checked compared to their deadline
+        self.queue_depth = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, service, delay=0):
+        """
+        Schedule a service to be checked after `delay` seconds
+        """
+        self.remove(service)
+        entry = [time.time() + delay, next(self._sequence), service]
+        self._entries[service] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, service):
+        for onion_address in self._warming_up.pop(service, ()):
+            services = self._warming_up_by_address[onion_address]
+            services.discard(service)
+            if not services:
+                del self._warming_up_by_address[onion_address]
+        entry = self._entries.pop(service, None)
+        if entry:
+            entry[-1] = None
+
+    def warm_up(self, service, timeout):
+        """
+        Schedule the first publish of a service for as soon as a fetch of
+        each of its instances has finished, or after `timeout` seconds
+        """
+        self.add(service, delay=timeout)
+
+        # Instances restored from the saved state are already online
+        pending = set(instance.onion_address
+                      for instance in service.instances
+                      if not (instance.fetch_attempted or
+                              instance.get_state() == 'online'))
+        if not pending:
+            self._warmed_up(service)
+            return
+
+        self._warming_up[service] = pending
+        for onion_address in pending:
+            self._warming_up_by_address.setdefault(onion_address,
+                                                   set()).add(service)
+
+    def instance_fetched(self, onion_address):
+        """
+        Publish the warming up services which were waiting for a fetch of
+        an instance address, once all of their instances have been fetched
+        """
+        services = self._warming_up_by_address.pop(onion_address, ())
+        for service in services:
+            pending = self._warming_up[service]
+            pending.discard(onion_address)
+            if not pending:
+                self._warmed_up(service)
+
+    def _warmed_up(self, service):
+        self._warming_up.pop(service, None)
+        logger.info("Fetched all instances of service %s.onion, publishing "
+                    "its first descriptor.", service.onion_address)
+        self.add(service)
+
+    def next_deadline(self):
+        """
+        Return the earliest deadline of any scheduled service, or None
+        """
+        while self._heap and self._heap[0][-1] is None:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def run_pending(self, now=None):
+        """
+        Publish all services whose deadline has passed and schedule their
+        next check
+        """
+        if not now:
+            now = time.time()
+
+        due_services = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, service = heapq.heappop(self._heap)
+            if service is None:
+                continue
+            del self._entries[service]
+            due_services.append(service)
+
+            self.last_lateness = now - deadline
+            self.max_lateness = max(self.max_lateness, self.last_lateness)
+
+        self.queue_depth = len(due_services)
+        if not due_services:
+            return
+
+        try:
+            publish_descriptors(due_services)
+        finally:
+            for service in due_services:
+                self.add(service, delay=config.PUBLISH_CHECK_INTERVAL *
+                         random.uniform(1 - self.JITTER, 1 + self.JITTER))
+
+
+# Publish deadlines for each service
+publish_scheduler = PublishScheduler()
+
+
+# Processes used to sign the descriptors of each service, by onion address
+signing_workers = {}
+
+# Key and descriptor template of the service in a signing worker process
+_worker_key = None
+
+
+def start_signing_pool(num_workers):
+    """
+    Start a process to sign the descriptors of each service, for at most
+    `num_workers` services
+
+    Each worker loads only its own service's key from the service's key
+    file, so private keys are never passed between processes. Services
+    with an encrypted key, or without a worker, are signed in the main
+    process. The workers must be started after the services are loaded,
+    and restarted when services are added. They are spawned as fresh
+    processes rather than forked, as forking while the stem, metrics and
+    descriptor parsing threads are running could leave a worker holding a
+    lock which is never released.
+    """
+    stop_signing_pool()
+    if num_workers < 1:
+        return
+
+    try:
+        context = multiprocessing.get_context('spawn')
+    except AttributeError:
+        logger.warning("Signing descriptors in the main process, signing "
+                       "workers require Python 3.")
+        return
+
     for service in config.services:
-        service.descriptor_publish()
+        if len(signing_workers) >= num_workers:
+            logger.warning("Only %d of %d services have a signing worker, "
+                           "the others are signed in the main process.",
+                           len(signing_workers), len(config.services))
+            break
+        if not _can_load_key_in_worker(service.key_path):
+            logger.info("Signing descriptors for service %s.onion in the "
+                        "main process, its key is encrypted.",
+                        service.onion_address)
+            continue
+        signing_workers[service.onion_address] = context.Pool(
+            1, initializer=_init_signing_worker,
+            initargs=(service.key_path, service.onion_address))
+    logger.debug("Started %d descriptor signing processes.",
+                 len(signing_workers))
+
+
+def stop_signing_pool():
+    while signing_workers:
+        _, worker = signing_workers.popitem()
+        worker.terminate()
+
+
+def _can_load_key_in_worker(key_path):
+    """
+    Check that a key file can be loaded without prompting for a passphrase
+    """
+    if not key_path:
+        return False
+    try:
+        with open(key_path, 'rt') as handle:
+            return not util.is_encrypted_key(handle.read())
+    except (IOError, OSError):
+        return False
+
+
+def _init_signing_worker(key_path, onion_address):
+    """
+    Load the key of a service in its new signing worker process
+
+    If the key file no longer holds the service's key, no key is loaded and
+    the service is signed in the main process.
+    """
+    global _worker_key
+    try:
+        with open(key_path, 'rt') as handle:
+            service_key = Crypto.PublicKey.RSA.importKey(handle.read())
+    except (IOError, OSError, ValueError):
+        return
+    template = descriptor.DescriptorTemplate(service_key)
+    if template.onion_address == onion_address:
+        _worker_key = (service_key, template)
+
+
+def _sign_in_worker(introduction_points, replica, timestamp, deviation):
+    """
+    Generate a signed descriptor in a signing worker process
+    """
+    if not _worker_key:
+        raise ValueError("The service key is not loaded in the signing "
+                         "worker.")
+    service_key, template = _worker_key
+    return descriptor.generate_service_descriptor(
+        service_key,
+        introduction_point_list=introduction_points,
+        replica=replica,
+        timestamp=timestamp,
+        deviation=deviation,
+        template=template
+    )
+
+
+def _generate_descriptor(job, result, deadline):
+    """
+    Return the signed descriptor for a job, from its signing worker's
+    `result` if there is one
+
+    If the worker fails or does not respond by `deadline`, for example
+    because it was killed, the descriptor is signed in this process
+    instead.
+    """
+    if result:
+        try:
+            return result.get(timeout=max(deadline - time.time(), 0))
+        except multiprocessing.TimeoutError:
+            logger.warning("Signing worker did not sign the descriptor for "
+                           "service %s.onion in time, signing it in the "
+                           "main process.", job.service.onion_address)
+        except Exception as exc:
+            logger.warning("Signing worker failed to sign the descriptor "
+                           "for service %s.onion, signing it in the main "
+                           "process: %s", job.service.onion_address, exc)
+
+    return job.service.generate_descriptor(
+        job.introduction_points, job.replica, job.timestamp, job.deviation)
+
+
+def sign_descriptors(jobs):
+    """
+    Sign the descriptor for each DescriptorJob
+
+    Previously signed descriptors are reused. The remaining descriptors are
+    signed by their service's signing worker if it has one, otherwise on
+    this thread. All of the jobs are submitted to the workers before any
+    result is waited for, and the results share one SIGNING_TIMEOUT
+    deadline. Jobs which fail have their `signed_descriptor` left as None.
+    """
+    started = time.time()
+    pending = []
+    for job in jobs:
+        job.signed_descriptor = job.service.get_cached_descriptor(job)
+        if job.signed_descriptor:
+            continue
+
+        worker = signing_workers.get(job.service.onion_address)
+        if worker:
+            pending.append((job, worker.apply_async(
+                _sign_in_worker,
+                (job.introduction_points, job.replica, job.timestamp,
+                 job.deviation))))
+        else:
+            pending.append((job, None))
+
+    deadline = time.time() + config.SIGNING_TIMEOUT
+    for job, result in pending:
+        try:
+            signed_descriptor = _generate_descriptor(job, result, deadline)
+        except ValueError as exc:
+            logger.warning("Error generating master descriptor: %s", exc)
+        else:
+            job.signed_descriptor = signed_descriptor
+            job.service.cache_descriptor(job)
+
+    if pending:
+        metrics.descriptor_sign_seconds.observe(time.time() - started)
+
+
+class DescriptorJob(object):
+    """
+    A master descriptor to be signed and uploaded for one replica and time
+    period of a service.
+    """
+    __slots__ = ('service', 'replica', 'deviation', 'descriptor_id',
+                 'timestamp', 'introduction_points', 'signed_descriptor')
+
+    def __init__(self, service, replica, deviation, descriptor_id, timestamp,
+                 introduction_points):
+        self.service = service
+        self.replica = replica
+        self.deviation = deviation
+        self.descriptor_id = descriptor_id
+        self.timestamp = timestamp
+        self.introduction_points = introduction_points
+        self.signed_descriptor = None
+
+    @property
+    def cache_key(self):
+        """
+        A signed descriptor only depends on the replica, the time period
+        (both part of the descriptor ID), the publication time rounded to
+        the hour and the set of introduction points.
+        """
+        return (self.replica, self.descriptor_id,
+                util.rounded_timestamp(self.timestamp),
+                frozenset(ip.identifier for ip in self.introduction_points))
 
 
 class Service(object):
@@ -34,12 +395,16 @@ class Service(object):
     be load-balanced.
     """
 
-    def __init__(self, controller, service_key=None, instances=None):
+    def __init__(self, controller, service_key=None, instances=None,
+                 key_path=None):
         """
         Initialise a HiddenService object.
         """
         self.controller = controller
 
+        # Path of the key file, used to load the key in a signing worker
+        self.key_path = key_path
+
         # Service key must be a valid PyCrypto RSA key object
         if isinstance(service_key, Crypto.PublicKey.RSA._RSAobj):
             self.service_key = service_key
@@ -51,19 +416,44 @@ class Service(object):
             instances = []
         self.instances = instances
 
+        # Precompute the static parts of this service's descriptors
+        self.descriptor_template = descriptor.DescriptorTemplate(
+            self.service_key)
+
         # Calculate the onion address for this service
-        self.onion_address = util.calc_onion_address(self.service_key)
+        self.onion_address = self.descriptor_template.onion_address
 
         # Timestamp when this descriptor was last attempted
         self.uploaded = None
 
+        # Whether Tor has accepted a descriptor for this service since
+        # startup
+        self.ready = False
+
+        # Flag when instances were added, removed or reweighted by a config
+        # reload so that a new master descriptor is published
+        self.instances_changed = False
+
+        # Recently signed descriptors for each replica and time period
+        self._signed_descriptors = util.LRUCache(4 * config.REPLICAS)
+
+        # Identifiers of the last selected introduction points for each
+        # descriptor ID, or under None when all descriptors share one set
+        self._published_intro_points = {}
+
+        # Number of introduction points added and removed by the last
+        # selection, and the number of distinct introduction points in all
+        # of the service's descriptors
+        self.intro_point_churn = (0, 0)
+        self.intro_point_fanout = 0
+
     def _intro_points_modified(self):
         """
         Check if the introduction point set has changed since last
         publish.
         """
-        return any(instance.changed_since_published
-                   for instance in self.instances)
+        return self.instances_changed or any(
+            instance.changed_since_published for instance in self.instances)
 
     def _descriptor_not_uploaded_recently(self):
         """
@@ -83,7 +473,7 @@ class Service(object):
         """
         If the descriptor ID will change soon, upload under both descriptor IDs
         """
-        permanent_id = base64.b32decode(self.onion_address, 1)
+        permanent_id = self.descriptor_template.permanent_id
         seconds_valid = util.get_seconds_valid(time.time(), permanent_id)
 
         # Check if descriptor ID will be changing within the overlap period.
@@ -92,29 +482,24 @@ class Service(object):
         else:
             return False
 
-    def _select_introduction_points(self):
+    def _eligible_introduction_points(self):
         """
-        Choose set of introduction points from all fresh descriptors
+        Collect the introduction points and weights of all instances with
+        fresh descriptors
         """
         available_intro_points = []
+        weights = []
+        self.instances_changed = False
 
         # Loop through each instance and determine fresh intro points
         for instance in self.instances:
-            if not instance.received:
+            state = instance.get_state()
+            if state == 'offline':
                 logger.info("No descriptor received for instance %s.onion "
                             "yet.", instance.onion_address)
                 continue
 
-            # The instance may be offline if no descriptor has been received
-            # for it recently or if the received descriptor's timestamp is
-            # too old
-            received_age = datetime.datetime.utcnow() - instance.received
-            timestamp_age = datetime.datetime.utcnow() - instance.timestamp
-            received_age = received_age.total_seconds()
-            timestamp_age = timestamp_age.total_seconds()
-
-            if (received_age > config.DESCRIPTOR_UPLOAD_PERIOD or
-                    timestamp_age > (4 * 60 * 60)):
+            if state == 'stale':
                 logger.info("Our descriptor for instance %s.onion is too old. "
                             "The instance may be offline. It's introduction "
                             "points will not be included in the master "
@@ -124,54 +509,181 @@ class Service(object):
                 # Include this instance's introduction points
                 instance.changed_since_published = False
                 available_intro_points.append(instance.introduction_points)
+                weights.append(instance.get_weight())
+
+        return available_intro_points, weights
 
+    def _select_introduction_points(self, descriptor_ids):
+        """
+        Choose the introduction points for the descriptors with each of the
+        given descriptor IDs from all fresh descriptors
+
+        Normally the same set is used for every descriptor. If
+        DISTINCT_REPLICA_INTRO_POINTS is enabled and more than
+        MAX_INTRO_POINTS introduction points are available, the
+        introduction points are instead partitioned into a distinct set per
+        descriptor.
+
+        Return a dict of descriptor ID -> list of IntroductionPoints.
+        """
+        available_intro_points, weights = \
+            self._eligible_introduction_points()
         num_intro_points = sum(len(ips) for ips in available_intro_points)
-        choosen_intro_points = descriptor.choose_introduction_point_set(
-            available_intro_points)
-
-        logger.debug("Selected %d IPs of %d for service %s.onion.",
-                     len(choosen_intro_points), num_intro_points,
-                     self.onion_address)
-
-        return choosen_intro_points
-
-    def _publish_descriptor(self, deviation=0):
-        """
-        Create, sign and uploads a master descriptor for this service
-        """
-        introduction_points = self._select_introduction_points()
-        for replica in range(0, config.REPLICAS):
-            try:
-                signed_descriptor = descriptor.generate_service_descriptor(
-                    self.service_key,
-                    introduction_point_list=introduction_points,
-                    replica=replica,
-                    deviation=deviation
-                )
-            except ValueError as exc:
-                logger.warning("Error generating master descriptor: %s", exc)
+        previous = self._published_intro_points
+
+        if (config.DISTINCT_REPLICA_INTRO_POINTS and
+                num_intro_points > config.MAX_INTRO_POINTS):
+            # Keep introduction points in the descriptor they were published
+            # in, where possible
+            assignment = {}
+            for index, descriptor_id in enumerate(descriptor_ids):
+                for identifier in previous.get(descriptor_id, ()):
+                    assignment[identifier] = index
+            partitions = descriptor.partition_introduction_points(
+                available_intro_points, len(descriptor_ids), assignment)
+            keys = descriptor_ids
+        else:
+            partitions = [available_intro_points]
+            keys = [None]
+
+        published = {}
+        selections = {}
+        for key, partition in zip(keys, partitions):
+            choosen_intro_points = descriptor.choose_introduction_point_set(
+                partition,
+                previous.get(key) if config.STABLE_INTRO_POINTS else None,
+                weights)
+            published[key] = frozenset(ip.identifier
+                                       for ip in choosen_intro_points)
+            selections[key] = choosen_intro_points
+        self._published_intro_points = published
+
+        before = frozenset().union(*previous.values())
+        after = frozenset().union(*published.values())
+        self.intro_point_churn = (len(after - before), len(before - after))
+        self.intro_point_fanout = len(after)
+
+        logger.debug("Selected %d IPs of %d in %d sets for service "
+                     "%s.onion.", len(after), num_intro_points,
+                     len(selections), self.onion_address)
+        if after != before:
+            logger.info("Introduction point set for service %s.onion "
+                        "changed: %d added, %d removed, %d published in "
+                        "total.", self.onion_address,
+                        self.intro_point_churn[0], self.intro_point_churn[1],
+                        self.intro_point_fanout)
+
+        if None in selections:
+            return dict((descriptor_id, selections[None])
+                        for descriptor_id in descriptor_ids)
+        return selections
+
+    def get_cached_descriptor(self, job):
+        """
+        Return a previously signed descriptor for a job if nothing it
+        contains has changed.
+        """
+        signed_descriptor = self._signed_descriptors.get(job.cache_key)
+        if signed_descriptor:
+            logger.debug("Reusing the signed descriptor for service %s.onion "
+                         "under replica %d.", self.onion_address, job.replica)
+        return signed_descriptor
+
+    def cache_descriptor(self, job):
+        self._signed_descriptors.set(job.cache_key, job.signed_descriptor)
+
+    def generate_descriptor(self, introduction_points, replica, timestamp,
+                            deviation):
+        """
+        Generate and sign a descriptor for this service
+        """
+        return descriptor.generate_service_descriptor(
+            self.service_key,
+            introduction_point_list=introduction_points,
+            replica=replica,
+            timestamp=timestamp,
+            deviation=deviation,
+            template=self.descriptor_template
+        )
+
+    def _descriptor_jobs(self, deviations=(0,)):
+        """
+        Select introduction points and create the descriptor jobs for each
+        replica of this service under each time period deviation
+        """
+        permanent_id = self.descriptor_template.permanent_id
+        timestamp = datetime.datetime.utcnow()
+        jobs = [DescriptorJob(self, replica, deviation,
+                              descriptor.get_descriptor_id(
+                                  permanent_id, replica, timestamp, deviation),
+                              timestamp, None)
+                for deviation in deviations
+                for replica in range(0, config.REPLICAS)]
+
+        introduction_points = self._select_introduction_points(
+            [job.descriptor_id for job in jobs])
+        for job in jobs:
+            job.introduction_points = introduction_points[job.descriptor_id]
+        return jobs
+
+    def upload_descriptors(self, jobs):
+        """
+        Upload the signed descriptors for this service
+        """
+        jobs = [job for job in jobs if job.signed_descriptor]
+        uploads = []
+        for job in jobs:
+            # Upload to the HSDirs responsible for this replica. Tor will
+            # choose the HSDirs itself if none are known.
+            hsdirs = consensus.hsdir_ring.get_responsible_hsdirs(
+                job.descriptor_id)
+
+            # Track the result of the upload to each HSDir
+            upload.upload_tracker.expect(self, job.replica, job.deviation,
+                                         job.descriptor_id,
+                                         job.signed_descriptor, hsdirs)
+            uploads.append((job.signed_descriptor, hsdirs))
+
+        # Signed descriptors were generated successfully, upload them
+        results = descriptor.upload_descriptors(self.controller, uploads)
+        for job, (_, hsdirs), error in zip(jobs, uploads, results):
+            metrics.hspost_commands.inc(service=self.onion_address,
+                                        result='error' if error else 'ok')
+            if error:
+                logger.error("Error uploading descriptor for service "
+                             "%s.onion under replica %d: %s",
+                             self.onion_address, job.replica, error)
+                upload.upload_tracker.upload_error(
+                    upload.upload_tracker.get_upload(job.descriptor_id),
+                    hsdirs)
             else:
-                # Signed descriptor was generated successfully, upload it
-                try:
-                    descriptor.upload_descriptor(self.controller,
-                                                 signed_descriptor)
-                except stem.ControllerError:
-                    logger.exception("Error uploading descriptor for service "
-                                     "%s.onion.", self.onion_address)
-                else:
-                    logger.info("Published a descriptor for service "
-                                "%s.onion under replica %d.",
-                                self.onion_address, replica)
-
-        # It would be better to set last_uploaded when an upload succeeds and
-        # not when an upload is just attempted. Unfortunately the HS_DESC #
-        # UPLOADED event does not provide information about the service and
-        # so it can't be used to determine when descriptor upload succeeds
+                logger.info("Published a descriptor for service "
+                            "%s.onion under replica %d.",
+                            self.onion_address, job.replica)
+                if not self.ready:
+                    logger.info("Service %s.onion is ready.",
+                                self.onion_address)
+                    self.ready = True
+
+        # Timestamp of the last upload attempt. The result of the upload to
+        # each HSDir is tracked from the HS_DESC events by the upload tracker.
         self.uploaded = datetime.datetime.utcnow()
+        state.state_store.changed()
 
-    def descriptor_publish(self, force_publish=False):
+    def upload_confirmed(self, replica, deviation=0):
         """
-        Publish descriptor if have new IP's or if descriptor has expired
+        Check if the latest descriptor for a replica was accepted by at
+        least one HSDir
+        """
+        return any(descriptor_upload.confirmed for descriptor_upload
+                   in upload.upload_tracker.get_uploads(self)
+                   if (descriptor_upload.replica == replica and
+                       descriptor_upload.deviation == deviation))
+
+    def prepare_publish(self, force_publish=False):
+        """
+        Decide if a descriptor should be published and return the descriptor
+        jobs to sign and upload
         """
 
         # A descriptor should be published if any of the following conditions
@@ -182,15 +694,26 @@ class Service(object):
 
             logger.debug("Publishing a descriptor for service %s.onion.",
                          self.onion_address)
-            self._publish_descriptor()
+            deviations = [0]
 
             # If the descriptor ID will change soon, need to upload under
             # the new ID too.
             if self._descriptor_id_changing_soon():
                 logger.info("Publishing a descriptor for service %s.onion "
                             "under next descriptor ID.", self.onion_address)
-                self._publish_descriptor(deviation=1)
+                deviations.append(1)
+            return self._descriptor_jobs(deviations)
 
         else:
             logger.debug("Not publishing a new descriptor for service "
                          "%s.onion.", self.onion_address)
+            return []
+
+    def descriptor_publish(self, force_publish=False):
+        """
+        Publish descriptor if have new IP's or if descriptor has expired
+        """
+        jobs = self.prepare_publish(force_publish)
+        if jobs:
+            sign_descriptors(jobs)
+            self.upload_descriptors(jobs)
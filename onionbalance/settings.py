@@ -19,8 +19,11 @@ from onionbalance import config
 from onionbalance import util
 from onionbalance import log
 
+import onionbalance.descriptor
 import onionbalance.service
 import onionbalance.instance
+import onionbalance.state
+import onionbalance.upload
 
 logger = log.get_logger()
 
@@ -46,66 +49,285 @@ def parse_config_file(config_file):
     for service in config_data.get('services'):
         if not os.path.isabs(service.get('key')):
             service['key'] = os.path.join(config_directory, service['key'])
+        for instance in service.get('instances') or []:
+            load_report = instance.get('load_report')
+            if load_report and not os.path.isabs(load_report):
+                instance['load_report'] = os.path.join(config_directory,
+                                                       load_report)
 
     return config_data
 
 
-def initialize_services(controller, services_config):
-    """
-    Load keys for services listed in the config
+# Service private keys which have been loaded, by key file path, with the
+# file's inode, modification time and size when it was loaded. Keys are
+# reused when the config is reloaded so encrypted keys are not prompted for
+# again, unless the key file was replaced.
+loaded_keys = {}
+
+
+def load_service_key(key_path, prompt=True):
     """
+    Load the private key of a service, reusing the key if the key file is
+    unchanged since it was last loaded
 
-    # Load the keys and config for each onion service
-    for service in services_config:
-        try:
-            service_key = util.key_decrypt_prompt(service.get("key"))
-        except OSError as e:
-            if e.errno == errno.ENOENT:
-                logger.error("Private key file %s could not be found. "
+    Raises ValueError if the key cannot be loaded, or if it is encrypted
+    and `prompt` is False.
+    """
+    try:
+        key_stat = os.stat(key_path)
+        file_version = (key_stat.st_ino, key_stat.st_mtime, key_stat.st_size)
+        loaded_version, service_key = loaded_keys.get(key_path, (None, None))
+        if service_key and loaded_version == file_version:
+            return service_key
+        if not prompt:
+            with open(key_path, 'rt') as handle:
+                if util.is_encrypted_key(handle.read()):
+                    raise ValueError("Private key %s is encrypted and can "
+                                     "only be loaded at startup." %
+                                     key_path)
+        service_key = util.key_decrypt_prompt(key_path)
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            raise ValueError("Private key file %s could not be found. "
                              "Relative paths in the config file are loaded "
-                             "relative to the config file directory.",
-                             service.get("key"))
-                sys.exit(1)
-            else:
-                raise
-        # Key file was read but a valid private key was not found.
-        if not service_key:
-            logger.error("Private key %s could not be loaded. It is a not "
-                         "valid 1024 bit PEM encoded RSA private key",
-                         service.get("key"))
-            sys.exit(1)
+                             "relative to the config file directory." %
+                             key_path)
         else:
-            # Successfully imported the private key
-            onion_address = util.calc_onion_address(service_key)
-            logger.debug("Loaded private key for service %s.onion.",
-                         onion_address)
+            raise
+    # Key file was read but a valid private key was not found.
+    if not service_key:
+        raise ValueError("Private key %s could not be loaded. It is a not "
+                         "valid 1024 bit PEM encoded RSA private key" %
+                         key_path)
+
+    loaded_keys[key_path] = (file_version, service_key)
+    return service_key
+
+
+def parse_instance_config(instance):
+    """
+    Validate the config of an instance and return the arguments to create
+    the Instance with
+
+    Raises ValueError if the config is invalid.
+    """
+    weight = instance.get("weight", 1)
+    if (not isinstance(weight, (int, float)) or
+            isinstance(weight, bool) or weight <= 0):
+        raise ValueError("The weight of instance %s.onion must be a "
+                         "positive number." % instance.get("address"))
+    return {
+        'onion_address': instance.get("address"),
+        'authentication_cookie': instance.get("auth"),
+        'weight': weight,
+        'load_report': instance.get("load_report"),
+    }
+
+
+def parse_services_config(services_config, prompt=True):
+    """
+    Load the keys and validate the instances of the services in the config,
+    prompting for the passphrase of encrypted keys if `prompt` is True
+
+    Returns a list of (service key, key path, onion address, instance
+    arguments) tuples. Raises ValueError if any service is invalid.
+    """
+    services = []
+    for service in services_config or []:
+        service_key = load_service_key(service.get("key"), prompt)
+        onion_address = util.calc_onion_address(service_key)
+        logger.debug("Loaded private key for service %s.onion.",
+                     onion_address)
 
         # Load all instances for the current onion service
         instance_config = service.get("instances", [])
         if not instance_config:
-            logger.error("Could not load any instances for service "
-                         "%s.onion.", onion_address)
-            sys.exit(1)
-        else:
-            instances = []
-            for instance in instance_config:
-                instances.append(onionbalance.instance.Instance(
-                    controller=controller,
-                    onion_address=instance.get("address"),
-                    authentication_cookie=instance.get("auth")
-                ))
+            raise ValueError("Could not load any instances for service "
+                             "%s.onion." % onion_address)
+        services.append((service_key, service.get("key"), onion_address,
+                         [parse_instance_config(instance)
+                          for instance in instance_config]))
+    return services
 
-            logger.info("Loaded %d instances for service %s.onion.",
-                        len(instances), onion_address)
+
+def initialize_services(controller, services_config):
+    """
+    Load keys for services listed in the config
+    """
+    try:
+        services = parse_services_config(services_config)
+    except ValueError as exc:
+        logger.error("%s", exc)
+        sys.exit(1)
+
+    # Load the keys and config for each onion service
+    for service_key, key_path, onion_address, instances_config in services:
+        instances = [onionbalance.instance.Instance(controller=controller,
+                                                    **instance)
+                     for instance in instances_config]
+        logger.info("Loaded %d instances for service %s.onion.",
+                    len(instances), onion_address)
 
         # Store service configuration in config.services global
         config.services.append(onionbalance.service.Service(
             controller=controller,
             service_key=service_key,
-            instances=instances
+            instances=instances,
+            key_path=key_path
         ))
 
 
+def _update_instances(controller, service, instances_config):
+    """
+    Add, remove and update the instances of a running service to match
+    its config
+
+    Returns a tuple of whether any instances were added, and whether the
+    introduction points of the service may have changed.
+    """
+    configured = dict((instance['onion_address'], instance)
+                      for instance in instances_config)
+    modified = False
+
+    for instance in list(service.instances):
+        if instance.onion_address not in configured:
+            logger.info("Removing instance %s.onion from service %s.onion.",
+                        instance.onion_address, service.onion_address)
+            config.services.remove_instance(service, instance)
+            modified = True
+
+    current = set(instance.onion_address for instance in service.instances)
+    added = False
+    for instance_config in instances_config:
+        if instance_config['onion_address'] not in current:
+            logger.info("Adding instance %s.onion to service %s.onion.",
+                        instance_config['onion_address'],
+                        service.onion_address)
+            config.services.add_instance(service, onionbalance.instance.
+                                         Instance(controller=controller,
+                                                  **instance_config))
+            onionbalance.descriptor.forget_received_descriptors(
+                instance_config['onion_address'])
+            current.add(instance_config['onion_address'])
+            added = modified = True
+
+    # Update the settings of the instances which were kept. Their
+    # descriptors are kept unless they must be decrypted with a new cookie.
+    for instance in service.instances:
+        instance_config = configured[instance.onion_address]
+        if (instance.authentication_cookie !=
+                instance_config['authentication_cookie']):
+            logger.info("Authentication cookie changed for instance "
+                        "%s.onion, fetching its descriptor again.",
+                        instance.onion_address)
+            instance.authentication_cookie = \
+                instance_config['authentication_cookie']
+            instance.next_fetch = 0
+            onionbalance.descriptor.forget_received_descriptors(
+                instance.onion_address)
+        if (instance.weight != instance_config['weight'] or
+                instance.load_report != instance_config['load_report']):
+            instance.weight = instance_config['weight']
+            instance.load_report = instance_config['load_report']
+            modified = True
+
+    return added, modified
+
+
+def reload_services(controller, services_config):
+    """
+    Update the running services and their instances to match a reloaded
+    config
+
+    Services and instances which are unchanged keep their descriptors and
+    schedules. Only services whose instances changed are published again.
+    If the new config is invalid, the running services are left unchanged.
+    Passphrases cannot be prompted for while running, so a reload which
+    needs an encrypted key to be loaded again is also rejected.
+    """
+    try:
+        services = parse_services_config(services_config, prompt=False)
+    except ValueError as exc:
+        logger.error("Not reloading the services: %s", exc)
+        return False
+
+    scheduler = onionbalance.service.publish_scheduler
+    configured = dict((onion_address, (service_key, instances_config))
+                      for service_key, _, onion_address, instances_config
+                      in services)
+    services_changed = False
+
+    for service in list(config.services):
+        if service.onion_address not in configured:
+            logger.info("Removing service %s.onion.", service.onion_address)
+            config.services.remove(service)
+            scheduler.remove(service)
+            onionbalance.upload.upload_tracker.remove_service(service)
+            services_changed = True
+
+    current = dict((service.onion_address, service)
+                   for service in config.services)
+    for service_key, key_path, onion_address, instances_config in services:
+        service = current.get(onion_address)
+        if not service:
+            service = onionbalance.service.Service(
+                controller=controller,
+                service_key=service_key,
+                instances=[onionbalance.instance.Instance(
+                    controller=controller, **instance)
+                    for instance in instances_config],
+                key_path=key_path)
+            logger.info("Adding service %s.onion with %d instances.",
+                        onion_address, len(service.instances))
+            config.services.append(service)
+            current[onion_address] = service
+            for instance in service.instances:
+                onionbalance.descriptor.forget_received_descriptors(
+                    instance.onion_address)
+            scheduler.warm_up(service, config.WARMUP_TIMEOUT)
+            services_changed = True
+            continue
+
+        service.key_path = key_path
+        added, modified = _update_instances(controller, service,
+                                            instances_config)
+        if modified:
+            service.instances_changed = True
+        if added:
+            # Publish once the new instances have been fetched
+            scheduler.warm_up(service, config.WARMUP_TIMEOUT)
+        elif modified:
+            scheduler.add(service)
+
+    # Signing workers are only started for the services which were loaded
+    # when the workers were started
+    if services_changed and config.SIGNING_WORKERS:
+        onionbalance.service.start_signing_pool(config.SIGNING_WORKERS)
+
+    onionbalance.state.state_store.changed()
+    logger.info("Reloaded %d services.", len(config.services))
+    return True
+
+
+def reload_config(controller, config_file):
+    """
+    Reload the services from the config file
+    """
+    config_path = os.path.abspath(config_file)
+    if not os.path.exists(config_path):
+        logger.error("Not reloading the config, the config file '%s' does "
+                     "not exist.", config_path)
+        return False
+
+    try:
+        config_data = parse_config_file(config_file)
+    except (IOError, OSError, yaml.YAMLError) as exc:
+        logger.error("Unable to reload the config file '%s': %s",
+                     config_path, exc)
+        return False
+    return reload_services(controller, config_data.get('services'))
+
+
 def parse_cmd_args():
     """
     Parses and returns command line arguments for config generator
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Save the received instance descriptors and service upload times to disk so
+that services can be published straight away after a restart.
+"""
+import calendar
+import datetime
+import json
+import os
+import tempfile
+import time
+
+import Crypto.PublicKey.RSA
+import stem
+import stem.descriptor.hidden_service_descriptor
+
+from onionbalance import log
+from onionbalance import config
+from onionbalance import instance
+from onionbalance import util
+
+logger = log.get_logger()
+
+STATE_VERSION = 1
+
+
+def _to_timestamp(value):
+    if value is None:
+        return None
+    return calendar.timegm(value.utctimetuple())
+
+
+def _from_timestamp(value):
+    if value is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(value)
+
+
+def write_atomically(path, data):
+    """
+    Replace the file at `path` with `data` so that readers only ever see
+    the old or the new content, even if we crash while writing
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary_path = tempfile.mkstemp(prefix='.onionbalance-state-',
+                                          dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as handle:
+            handle.write(data)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.rename(temporary_path, path)
+    except Exception:
+        os.unlink(temporary_path)
+        raise
+
+
+class StateStore(object):
+    """
+    Snapshot of the service and instance state, saved to STATE_LOCATION.
+
+    Changes are coalesced and saved STATE_SAVE_DELAY seconds after the
+    first change, and once more on shutdown. Only the raw instance
+    descriptors are saved. They are parsed and validated again when the
+    state is loaded, and descriptors which have become too old to be
+    published are discarded.
+    """
+
+    def __init__(self):
+        # Time when unsaved changes should be written, or None
+        self._save_at = None
+
+    def changed(self):
+        """
+        Schedule a save of the state after a change
+        """
+        if config.STATE_LOCATION and self._save_at is None:
+            self._save_at = time.time() + config.STATE_SAVE_DELAY
+
+    def next_deadline(self):
+        return self._save_at
+
+    def snapshot(self, services):
+        """
+        Return the state of the services and their instances as a dict
+        """
+        instances = {}
+        for service in services:
+            for service_instance in service.instances:
+                if not service_instance.descriptor_content:
+                    continue
+                # Instances shared between services are saved once
+                instances[service_instance.onion_address] = {
+                    'descriptor': service_instance.descriptor_content,
+                    'received': _to_timestamp(service_instance.received),
+                    'last_changed': service_instance.last_changed,
+                    'publish_interval': service_instance.publish_interval,
+                }
+
+        return {
+            'version': STATE_VERSION,
+            'saved': int(time.time()),
+            'services': dict((service.onion_address,
+                              {'uploaded': _to_timestamp(service.uploaded)})
+                             for service in services),
+            'instances': instances,
+        }
+
+    def save(self, path=None):
+        """
+        Write the current state to disk
+        """
+        self._save_at = None
+        path = path or config.STATE_LOCATION
+        if not path:
+            return
+
+        started = time.time()
+        try:
+            write_atomically(path, json.dumps(self.snapshot(config.services),
+                                              separators=(',', ':')))
+        except (IOError, OSError) as exc:
+            logger.error("Unable to save the state to %s: %s", path, exc)
+        else:
+            logger.debug("Saved the state to %s in %.3f seconds.", path,
+                         time.time() - started)
+
+    def load(self, path=None, now=None):
+        """
+        Restore the saved state of the configured services and instances
+
+        Returns the number of instances restored from a saved descriptor.
+        """
+        path = path or config.STATE_LOCATION
+        if not path or not os.path.exists(path):
+            return 0
+
+        try:
+            with open(path, 'r') as handle:
+                state = json.load(handle)
+        except (IOError, OSError, ValueError) as exc:
+            logger.error("Unable to load the state from %s: %s", path, exc)
+            return 0
+
+        if not isinstance(state, dict) or \
+                state.get('version') != STATE_VERSION:
+            logger.warning("Ignoring the state in %s with an unsupported "
+                           "version.", path)
+            return 0
+
+        saved_services = state.get('services') or {}
+        for service in config.services:
+            saved_service = saved_services.get(service.onion_address)
+            if not saved_service:
+                continue
+            try:
+                service.uploaded = _from_timestamp(
+                    saved_service.get('uploaded'))
+            except (AttributeError, TypeError, ValueError, OverflowError,
+                    OSError):
+                logger.warning("Ignoring the invalid saved upload time of "
+                               "service %s.onion.", service.onion_address)
+
+        restored = 0
+        for onion_address, saved_instance in (state.get('instances') or
+                                              {}).items():
+            instances = config.services.get_instances(onion_address)
+            if instances:
+                restored += self._restore_instances(
+                    onion_address, instances, saved_instance, now)
+
+        logger.info("Restored the descriptors of %d instances from %s.",
+                    restored, path)
+        self._save_at = None
+        return restored
+
+    def _restore_instances(self, onion_address, instances, saved_instance,
+                           now=None):
+        """
+        Validate a saved descriptor and load it into the instances with its
+        onion address
+
+        Returns the number of instances which were restored.
+        """
+        now = now or datetime.datetime.utcnow()
+        try:
+            parsed_descriptor = stem.descriptor.hidden_service_descriptor.\
+                HiddenServiceDescriptor(
+                    saved_instance['descriptor'].encode('utf-8'),
+                    validate=True)
+            permanent_key = Crypto.PublicKey.RSA.importKey(
+                parsed_descriptor.permanent_key)
+            received = _from_timestamp(saved_instance['received'])
+            if received is None:
+                raise ValueError("No received time was saved.")
+        except (KeyError, TypeError, ValueError, OverflowError,
+                OSError) as exc:
+            logger.warning("Ignoring the invalid saved descriptor for "
+                           "instance %s.onion: %s", onion_address, exc)
+            return 0
+
+        if util.calc_onion_address(permanent_key) != onion_address:
+            logger.warning("Ignoring the saved descriptor for instance "
+                           "%s.onion which is for a different address.",
+                           onion_address)
+            return 0
+
+        # Only restore descriptors which could still be published
+        timestamp_age = (now - parsed_descriptor.published).total_seconds()
+        received_age = (now - received).total_seconds()
+        if (timestamp_age > instance.DESCRIPTOR_MAX_AGE or
+                received_age > config.DESCRIPTOR_UPLOAD_PERIOD):
+            logger.info("The saved descriptor for instance %s.onion is too "
+                        "old to be restored.", onion_address)
+            return 0
+
+        restored = 0
+        for service_instance in instances:
+            try:
+                introduction_points = \
+                    service_instance.decode_introduction_points(
+                        parsed_descriptor)
+            except (ValueError, stem.descriptor.hidden_service_descriptor.
+                    DecryptionFailure):
+                logger.warning("Unable to decode the introduction points "
+                               "in the saved descriptor for instance "
+                               "%s.onion.", onion_address)
+                continue
+
+            service_instance.update_descriptor(parsed_descriptor,
+                                               introduction_points)
+            service_instance.received = received
+            service_instance.last_changed = saved_instance.get(
+                'last_changed')
+            service_instance.publish_interval = saved_instance.get(
+                'publish_interval')
+
+            # Refresh the restored descriptor in the background
+            service_instance.next_fetch = 0
+            restored += 1
+        return restored
+
+
+# Saved state of the services shared by the event handlers and the manager
+state_store = StateStore()
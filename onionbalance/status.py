@@ -9,13 +9,119 @@ Default path: /var/run/onionbalance/control
 """
 
 from onionbalance import log
+from onionbalance import upload
+from onionbalance import service
+import collections
+import datetime
+import errno
+import json
 import os
+import select
 import socket
+import time
 
 logger = log.get_logger()
 
 LISTEN_TIMEOUT = 1  # seconds
 
+# Clients which send no command within this time receive the text summary
+LEGACY_TIMEOUT = 0.5  # seconds
+
+# Close connections which make no progress for this long
+CLIENT_TIMEOUT = 60  # seconds
+
+MAX_CLIENTS = 64
+MAX_COMMAND_SIZE = 64 * 1024
+
+# Generate more of a streamed response once less than this is buffered
+OUTPUT_LOW_WATER = 64 * 1024
+
+INSTANCE_STATES = ('online', 'stale', 'offline')
+
+
+def _timestamp(value):
+    return value.isoformat() if value else None
+
+
+def instance_status(instance, now=None):
+    """
+    Describe the state of an instance as a JSON serializable dict
+    """
+    return collections.OrderedDict([
+        ('address', instance.onion_address),
+        ('state', instance.get_state(now)),
+        ('timestamp', _timestamp(instance.timestamp)),
+        ('received', _timestamp(instance.received)),
+        ('intro_points', len(instance.introduction_points)),
+        ('weight', instance.weight),
+        ('fetch_failures', instance.fetch_failures),
+        ('next_fetch', instance.next_fetch),
+    ])
+
+
+def service_status(s):
+    """
+    Describe the state of a service as a JSON serializable dict
+    """
+    return collections.OrderedDict([
+        ('address', s.onion_address),
+        ('ready', s.ready),
+        ('uploaded', _timestamp(s.uploaded)),
+        ('intro_point_fanout', s.intro_point_fanout),
+        ('intro_point_churn', collections.OrderedDict([
+            ('added', s.intro_point_churn[0]),
+            ('removed', s.intro_point_churn[1])])),
+        ('replicas', [collections.OrderedDict([
+            ('replica', u.replica),
+            ('next_period', bool(u.deviation)),
+            ('confirmed', len(u.confirmed)),
+            ('hsdirs', len(u.hsdirs))])
+            for u in upload.upload_tracker.get_uploads(s)]),
+    ])
+
+
+class StatusClient(object):
+    """
+    A connection to the status socket and its buffered input and output
+    """
+
+    def __init__(self, conn, now):
+        self.conn = conn
+        self.input = b''
+        self.output = b''
+
+        # Generators of response chunks waiting to be sent
+        self.responses = collections.deque()
+
+        # Clients which send nothing before the deadline are sent the text
+        # summary
+        self.sent_command = False
+        self.legacy_deadline = now + LEGACY_TIMEOUT
+        self.last_activity = now
+
+        # Close the connection once all output is sent
+        self.closing = False
+
+    def wants_write(self):
+        return bool(self.output or self.responses)
+
+    def fill_output(self):
+        """
+        Generate more of the pending responses until enough output is
+        buffered
+        """
+        while self.responses and len(self.output) < OUTPUT_LOW_WATER:
+            try:
+                self.output += next(self.responses[0])
+            except StopIteration:
+                self.responses.popleft()
+
+    def finished(self):
+        return self.closing and not self.wants_write()
+
+    def awaiting_command(self):
+        return not (self.sent_command or self.closing)
+
 
 class StatusSocket():
     def __init__(self, config):
@@ -27,6 +133,15 @@ class StatusSocket():
               homkyx37cotkk3yg.onion None 0
               5a2pi3nyanlus5kj.onion 19:20:00 3 ips
 
+        Clients can instead send JSON commands, one per line, and receive
+        one JSON document per command::
+            echo '{"command": "service", "address": "pc47em2hovrmrkvm"}' |
+                socat - UNIX-CONNECT:/var/run/onionbalance/control
+
+        Commands are ``dump``, ``service`` and ``instance``, each taking an
+        optional ``state`` to only include instances which are ``online``,
+        ``stale`` or ``offline``. The ``ready`` command reports whether a
+        descriptor has been published for every service since startup.
         """
         self._config = config
         self._unix_socket_fname = config.CONTROL_SOCKET_LOCATION
@@ -39,39 +154,274 @@ class StatusSocket():
         self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self._sock.bind(self._unix_socket_fname)
         self._sock.listen(5)  # enqueue up to 5 connetction requests
-        self._sock.settimeout(LISTEN_TIMEOUT)
+        self._sock.setblocking(False)
+
+        # Map of socket file descriptor -> StatusClient
+        self._clients = {}
+
+    def readers(self):
+        """Sockets to watch for incoming connections and commands
+        """
+        return [self._sock] + [client.conn for client
+                               in self._clients.values()
+                               if not client.closing]
+
+    def writers(self):
+        """Sockets with responses waiting to be sent
+        """
+        return [client.conn for client in self._clients.values()
+                if client.wants_write()]
+
+    def timeout(self):
+        """Seconds until a client should be sent the text summary, or None
+        """
+        deadlines = [client.legacy_deadline for client
+                     in self._clients.values() if client.awaiting_command()]
+        if not deadlines:
+            return None
+        return max(min(deadlines) - time.time(), 0)
 
-    def listen_with_timeout(self):
-        """Listen for incoming status requests with at timeout
+    def listen_with_timeout(self, timeout=LISTEN_TIMEOUT):
+        """Wait up to `timeout` seconds for status socket activity and
+        handle all connections which are ready without blocking
         """
+        client_timeout = self.timeout()
+        if client_timeout is not None:
+            timeout = min(timeout, client_timeout)
         try:
-            conn, addr = self._sock.accept()
-            self.output_status(conn)
-        except socket.timeout:
+            readable, writable, _ = select.select(
+                self.readers(), self.writers(), [], timeout)
+        except (select.error, socket.error) as exc:
+            if exc.args[0] != errno.EINTR:
+                logger.error("Unexpected exception:", exc_info=True)
             return
-        except Exception:
-            logger.error("Unexpected exception:", exc_info=True)
+        self.handle_io(readable, writable)
 
-    def _write(self, conn, msg):
-        msg += "\n"
-        conn.send(msg.encode())
+    def handle_io(self, readable, writable):
+        """Handle the status sockets which are ready, ignoring any other
+        sockets
+        """
+        now = time.time()
+        if self._sock in readable:
+            try:
+                self._accept(now)
+            except Exception:
+                logger.error("Unexpected exception:", exc_info=True)
+
+        for client in list(self._clients.values()):
+            try:
+                if client.conn in readable:
+                    self._read(client, now)
+                    if client.conn.fileno() < 0:
+                        # The connection was closed while reading
+                        continue
+                if client.conn in writable and client.wants_write():
+                    self._send(client, now)
+            except Exception:
+                logger.error("Unexpected exception:", exc_info=True)
+                self._close_client(client.conn)
+
+        self._check_timeouts(now)
+
+    def _accept(self, now):
+        try:
+            conn, _ = self._sock.accept()
+        except socket.error as exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if len(self._clients) >= MAX_CLIENTS:
+            logger.warning("Too many status socket clients, closing a new "
+                           "connection.")
+            conn.close()
+            return
+        conn.setblocking(False)
+        self._clients[conn.fileno()] = StatusClient(conn, now)
+
+    def _read(self, client, now):
+        try:
+            data = client.conn.recv(4096)
+        except socket.error as exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+
+        client.last_activity = now
+        if not data:
+            # The client has finished sending commands. Clients which did
+            # not send any get the text summary.
+            if client.awaiting_command():
+                client.responses.append(self.output_status())
+            client.closing = True
+            self._send(client, now)
+            return
+
+        client.sent_command = True
+        client.input += data
+        while b'\n' in client.input:
+            line, client.input = client.input.split(b'\n', 1)
+            if line.strip():
+                client.responses.append(self._handle_command(line))
+
+        if len(client.input) > MAX_COMMAND_SIZE:
+            client.responses.append(self._error("Command too long."))
+            client.closing = True
+        self._send(client, now)
+
+    def _send(self, client, now):
+        client.fill_output()
+        while client.output:
+            try:
+                sent = client.conn.send(client.output)
+            except socket.error as exc:
+                if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if exc.args[0] in (errno.EPIPE, errno.ECONNRESET):
+                    # The client went away before reading its response
+                    self._close_client(client.conn)
+                    return
+                raise
+            client.output = client.output[sent:]
+            client.last_activity = now
+            client.fill_output()
+
+        if client.finished():
+            self._close_client(client.conn)
 
-    def output_status(self, conn):
-        """Output a status summary
+    def _check_timeouts(self, now):
+        for client in list(self._clients.values()):
+            if client.awaiting_command() and client.legacy_deadline <= now:
+                # The client never sent a command, send the text summary
+                client.responses.append(self.output_status())
+                client.closing = True
+                self._send(client, now)
+            elif now - client.last_activity > CLIENT_TIMEOUT:
+                logger.debug("Closing an idle status socket connection.")
+                self._close_client(client.conn)
+
+    def _close_client(self, conn):
+        self._clients.pop(conn.fileno(), None)
+        try:
+            conn.close()
+        except socket.error:
+            pass
+
+    def _error(self, message):
+        yield (json.dumps({'error': message}) + "\n").encode()
+
+    def _handle_command(self, line):
+        """
+        Parse a JSON command and return a generator of its response
+        """
+        try:
+            command = json.loads(line.decode('utf-8'))
+            name = command['command']
+            state = command.get('state')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self._error("Commands must be JSON objects with a "
+                               "'command'.")
+        if state is not None and state not in INSTANCE_STATES:
+            return self._error("Unknown instance state '%s'." % state)
+
+        if name == 'ready':
+            return iter([(json.dumps(self.readiness()) + "\n").encode()])
+        elif name == 'dump':
+            return self.output_json(self._config.services, state)
+        elif name == 'service':
+            services = [s for s in self._config.services
+                        if s.onion_address == command.get('address')]
+            if not services:
+                return self._error("Unknown service.")
+            return self.output_json(services, state)
+        elif name == 'instance':
+            instances = [instance_status(i) for i in
+                         self._config.services.get_instances(
+                             command.get('address'))]
+            instances = [i for i in instances
+                         if state is None or i['state'] == state]
+            if not instances:
+                return self._error("Unknown instance.")
+            return iter([(json.dumps({'instances': instances}) +
+                          "\n").encode()])
+        return self._error("Unknown command '%s'." % name)
+
+    def readiness(self):
+        """Report which services have been published since startup
+        """
+        services = collections.OrderedDict(
+            (s.onion_address, s.ready) for s in self._config.services)
+        return collections.OrderedDict([('ready', all(services.values())),
+                                        ('services', services)])
+
+    def output_json(self, services, state=None):
+        """Generate a JSON document describing the services and their
+        instances, one instance at a time so large responses are only
+        built as they are sent
+        """
+        now = datetime.datetime.utcnow()
+        scheduler = service.publish_scheduler
+        yield b'{"services": ['
+        for index, s in enumerate(services):
+            # Leave the service object open to stream its instances into
+            yield ((", " if index else "") +
+                   json.dumps(service_status(s))[:-1] +
+                   ', "instances": [').encode()
+            separator = ""
+            for i in s.instances:
+                instance = instance_status(i, now)
+                if state is None or instance['state'] == state:
+                    yield (separator + json.dumps(instance)).encode()
+                    separator = ", "
+            yield b']}'
+        summary = collections.OrderedDict([
+            ('services', len(scheduler)),
+            ('due', scheduler.queue_depth),
+            ('lateness', scheduler.last_lateness),
+            ('max_lateness', scheduler.max_lateness)])
+        yield ('], "ready": %s, "publish_scheduler": %s, '
+               '"upload_retry_queue": %d}\n' % (
+                   json.dumps(self.readiness()['ready']),
+                   json.dumps(summary),
+                   upload.upload_tracker.retry_queue_size())).encode()
+
+    def output_status(self):
+        """Generate a status summary, one line at a time
         """
         for s in self._config.services:
-            self._write(conn, "%s.onion %s" % (s.onion_address, s.uploaded))
+            yield ("%s.onion %s (%d intro points published, last churn: +%d "
+                   "-%d)\n" % ((s.onion_address, s.uploaded,
+                                s.intro_point_fanout) +
+                               s.intro_point_churn)).encode()
+            for u in upload.upload_tracker.get_uploads(s):
+                yield ("  replica %d%s: %d/%d HSDirs confirmed\n" % (
+                    u.replica, " (next period)" if u.deviation else "",
+                    len(u.confirmed), len(u.hsdirs))).encode()
             for i in s.instances:
                 if i.timestamp is None:
-                    self._write(conn, "  %s.onion [offline]" % i.onion_address)
+                    yield ("  %s.onion [offline]\n" %
+                           i.onion_address).encode()
                 else:
                     inp_cnt = len(i.introduction_points)
-                    line = "  %s.onion %s %s ips" % (
-                        i.onion_address, i.timestamp, inp_cnt)
-                    self._write(conn, line)
+                    yield ("  %s.onion %s %s ips\n" % (
+                        i.onion_address, i.timestamp, inp_cnt)).encode()
+
+        scheduler = service.publish_scheduler
+        yield ("publish scheduler: %d services, %d due, lateness %.1fs "
+               "(max %.1fs)\n" % (len(scheduler), scheduler.queue_depth,
+                                  scheduler.last_lateness,
+                                  scheduler.max_lateness)).encode()
+        yield ("upload retry queue: %d descriptors\n" %
+               upload.upload_tracker.retry_queue_size()).encode()
+        readiness = self.readiness()
+        yield ("ready: %s (%d/%d services published)\n" % (
+            "yes" if readiness['ready'] else "no",
+            sum(readiness['services'].values()),
+            len(readiness['services']))).encode()
 
     def close(self):
         """Close unix socket and remove its file
         """
+        for client in list(self._clients.values()):
+            self._close_client(client.conn)
         self._sock.close()
         os.remove(self._unix_socket_fname)
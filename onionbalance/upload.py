@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Track the upload of master descriptors to each HSDir.
+"""
+import collections
+import threading
+import time
+
+from onionbalance import descriptor
+from onionbalance import util
+from onionbalance import log
+from onionbalance import config
+from onionbalance import metrics
+
+logger = log.get_logger()
+
+
+class DescriptorUpload(object):
+    """
+    State of the upload of one signed descriptor to its HSDirs
+    """
+
+    def __init__(self, service, replica, deviation, descriptor_id,
+                 signed_descriptor, hsdirs):
+        self.service = service
+        self.replica = replica
+        self.deviation = deviation
+        self.descriptor_id = descriptor_id
+        self.signed_descriptor = signed_descriptor
+
+        # Map of HSDir fingerprint -> True if the upload was confirmed,
+        # False if it failed or None while the result is unknown
+        self.hsdirs = dict((hsdir, None) for hsdir in hsdirs)
+
+        # Number of times the failed HSDirs have been retried
+        self.retries = 0
+
+    @property
+    def confirmed(self):
+        return [hsdir for hsdir, state in self.hsdirs.items() if state]
+
+    @property
+    def failed(self):
+        return [hsdir for hsdir, state in self.hsdirs.items()
+                if state is False]
+
+
+class UploadTracker(object):
+    """
+    Correlate HS_DESC upload events with the descriptors we uploaded.
+
+    Tor emits a HS_DESC UPLOAD event with the HSDir and descriptor ID when
+    it begins an upload. The following UPLOADED or FAILED event only
+    identifies the HSDir, so it is matched to the oldest upload to that
+    HSDir which has not yet finished.
+
+    Failed uploads are placed on a bounded retry queue and retried with an
+    exponential backoff. Superseded descriptors are dropped from the queue.
+    """
+
+    def __init__(self):
+        # Map of base32 descriptor ID -> DescriptorUpload
+        self._uploads = {}
+
+        # Map of (service onion address, replica, deviation) -> descriptor
+        # ID of the latest upload
+        self._latest = {}
+
+        # Map of HSDir fingerprint -> descriptor IDs with uploads in progress
+        self._in_progress = collections.defaultdict(collections.deque)
+
+        # Map of descriptor ID -> time the failed upload should be retried,
+        # in the order the uploads failed
+        self._retry_queue = collections.OrderedDict()
+
+        # Events arrive on the stem event thread
+        self._lock = threading.Lock()
+
+    def _queue_retry(self, upload):
+        """
+        Queue a failed upload for a retry unless it is already queued
+
+        Must be called with the lock held.
+        """
+        if upload.descriptor_id in self._retry_queue:
+            return
+
+        delay = min(config.UPLOAD_RETRY_INTERVAL * 2 ** upload.retries,
+                    config.UPLOAD_RETRY_MAX_INTERVAL)
+        self._retry_queue[upload.descriptor_id] = time.time() + delay
+
+        # Drop the oldest failure rather than grow without bound when Tor
+        # keeps rejecting the uploads
+        if len(self._retry_queue) > config.UPLOAD_RETRY_QUEUE_SIZE:
+            dropped, _ = self._retry_queue.popitem(last=False)
+            logger.warning("Upload retry queue is full, not retrying the "
+                           "upload of descriptor %s.", dropped)
+
+    def expect(self, service, replica, deviation, descriptor_id,
+               signed_descriptor, hsdirs):
+        """
+        Register a descriptor which is about to be uploaded, replacing any
+        earlier upload for the same service, replica and deviation.
+        """
+        descriptor_id = util.base32_encode_str(descriptor_id)
+        key = (service.onion_address, replica, deviation)
+        with self._lock:
+            superseded = self._latest.get(key)
+            if superseded and superseded != descriptor_id:
+                self._uploads.pop(superseded, None)
+                self._retry_queue.pop(superseded, None)
+            self._latest[key] = descriptor_id
+            self._uploads[descriptor_id] = DescriptorUpload(
+                service, replica, deviation, descriptor_id,
+                signed_descriptor, hsdirs)
+
+    def upload_started(self, descriptor_id, hsdir):
+        """
+        Handle a HS_DESC UPLOAD event
+        """
+        with self._lock:
+            upload = self._uploads.get(descriptor_id)
+            if not upload:
+                return
+            upload.hsdirs[hsdir] = None
+            self._in_progress[hsdir].append(descriptor_id)
+
+    def upload_finished(self, hsdir, succeeded, reason=None):
+        """
+        Handle a HS_DESC UPLOADED or FAILED event for an upload
+
+        Returns the matching DescriptorUpload, or None if no upload to the
+        HSDir was in progress.
+        """
+        with self._lock:
+            in_progress = self._in_progress.get(hsdir)
+            upload = None
+            while in_progress and not upload:
+                upload = self._uploads.get(in_progress.popleft())
+            if in_progress is not None and not in_progress:
+                del self._in_progress[hsdir]
+            if not upload:
+                return None
+            upload.hsdirs[hsdir] = succeeded
+            if not succeeded:
+                self._queue_retry(upload)
+
+        metrics.hsdir_uploads.inc(service=upload.service.onion_address,
+                                  result='uploaded' if succeeded
+                                  else 'failed')
+
+        if succeeded:
+            logger.debug("Descriptor for service %s.onion under replica %d "
+                         "was uploaded to HSDir %s.",
+                         upload.service.onion_address, upload.replica, hsdir)
+        else:
+            logger.warning("Uploading the descriptor for service %s.onion "
+                           "under replica %d to HSDir %s failed (%s).",
+                           upload.service.onion_address, upload.replica,
+                           hsdir, reason)
+        return upload
+
+    def get_uploads(self, service):
+        """
+        Return the latest uploads for a service, ordered by deviation and
+        replica
+        """
+        with self._lock:
+            return sorted((upload for upload in self._uploads.values()
+                           if upload.service is service),
+                          key=lambda upload: (upload.deviation,
+                                              upload.replica))
+
+    def remove_service(self, service):
+        """
+        Forget the uploads of a service which is no longer managed
+        """
+        with self._lock:
+            for key in [key for key in self._latest
+                        if key[0] == service.onion_address]:
+                descriptor_id = self._latest.pop(key)
+                self._uploads.pop(descriptor_id, None)
+                self._retry_queue.pop(descriptor_id, None)
+
+    def start_retry(self, upload):
+        """
+        Mark the failed HSDirs of an upload as pending again and return them
+
+        An empty list means the upload should be retried to whichever HSDirs
+        Tor chooses.
+        """
+        with self._lock:
+            hsdirs = upload.failed
+            for hsdir in hsdirs:
+                upload.hsdirs[hsdir] = None
+            upload.retries += 1
+            return hsdirs
+
+    def upload_error(self, upload, hsdirs):
+        """
+        Mark HSDirs as failed when the HSPOST command itself failed
+        """
+        with self._lock:
+            for hsdir in hsdirs:
+                upload.hsdirs[hsdir] = False
+            self._queue_retry(upload)
+
+    def get_upload(self, descriptor_id):
+        with self._lock:
+            return self._uploads.get(util.base32_encode_str(descriptor_id))
+
+    def get_failed_uploads(self):
+        """
+        Return the uploads which failed on at least one HSDir
+        """
+        with self._lock:
+            return [upload for upload in self._uploads.values()
+                    if upload.failed]
+
+    def get_due_retries(self, now=None):
+        """
+        Remove and return the queued uploads whose retry is due
+
+        Uploads which have already been retried UPLOAD_RETRIES times are
+        dropped from the queue.
+        """
+        now = now or time.time()
+        due = []
+        with self._lock:
+            for descriptor_id, retry_at in list(self._retry_queue.items()):
+                if retry_at > now:
+                    continue
+                del self._retry_queue[descriptor_id]
+                upload = self._uploads.get(descriptor_id)
+                if not upload:
+                    continue
+                if upload.retries >= config.UPLOAD_RETRIES:
+                    logger.warning("Giving up on uploading the descriptor "
+                                   "for service %s.onion under replica %d "
+                                   "after %d retries.",
+                                   upload.service.onion_address,
+                                   upload.replica, upload.retries)
+                    continue
+                due.append(upload)
+        return due
+
+    def next_retry_deadline(self):
+        """
+        Return the time the next queued retry is due, or None
+        """
+        with self._lock:
+            return min(self._retry_queue.values()) if self._retry_queue \
+                else None
+
+    def retry_queue_size(self):
+        with self._lock:
+            return len(self._retry_queue)
+
+
+def retry_failed_uploads():
+    """
+    Upload descriptors again to only the HSDirs where the upload failed
+    """
+    # Group the retries by controller so each batch can be pipelined
+    retries = collections.OrderedDict()
+    for upload in upload_tracker.get_due_retries():
+        hsdirs = upload_tracker.start_retry(upload)
+        logger.info("Retrying the upload of the descriptor for service "
+                    "%s.onion under replica %d to %d HSDirs (retry %d).",
+                    upload.service.onion_address, upload.replica,
+                    len(hsdirs), upload.retries)
+        retries.setdefault(upload.service.controller, []).append(
+            (upload, hsdirs))
+
+    for controller, batch in retries.items():
+        results = descriptor.upload_descriptors(
+            controller, [(upload.signed_descriptor, hsdirs)
+                         for upload, hsdirs in batch])
+        for (upload, hsdirs), error in zip(batch, results):
+            metrics.hspost_commands.inc(service=upload.service.onion_address,
+                                        result='error' if error else 'ok')
+            if error:
+                logger.error("Error uploading descriptor for service "
+                             "%s.onion: %s", upload.service.onion_address,
+                             error)
+                upload_tracker.upload_error(upload, hsdirs)
+
+
+# Uploads of master descriptors shared by the services and event handlers
+upload_tracker = UploadTracker()
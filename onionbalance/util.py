@@ -6,6 +6,8 @@ import getpass
 import base64
 import binascii
 import os
+import collections
+import threading
 
 # import Crypto.Util
 import Crypto.PublicKey
@@ -92,6 +94,13 @@ def base32_encode_str(byte_str):
     return base64.b32encode(byte_str).lower().decode('utf-8')
 
 
+def is_encrypted_key(pem_key):
+    """
+    Check if a PEM encoded private key is encrypted with a passphrase
+    """
+    return "Proc-Type: 4,ENCRYPTED" in pem_key
+
+
 def key_decrypt_prompt(key_file, retries=3):
     """
     Try open an PEM encrypted private key, prompting the user for a
@@ -103,7 +112,7 @@ def key_decrypt_prompt(key_file, retries=3):
         pem_key = handle.read()
 
         for retries in range(0, retries):
-            if "Proc-Type: 4,ENCRYPTED" in pem_key:  # Key looks encrypted
+            if is_encrypted_key(pem_key):
                 key_passphrase = getpass.getpass(
                     "Enter the password for the private key (%s): " % key_file)
             try:
@@ -143,3 +152,51 @@ def is_directory_empty(path):
         return False
     else:
         return True
+
+
+class LRUCache(object):
+    """
+    Mapping which holds at most `max_size` items, discarding the least
+    recently used item when full. The cache can be shared between threads.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            # Re-insert the item to mark it as most recently used
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def discard_values(self, value):
+        """
+        Remove all items with the given value
+        """
+        with self._lock:
+            for key in [key for key, item_value in self._items.items()
+                        if item_value == value]:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the allocation of introduction point slots across instances.
+
+Compares `descriptor.allocate_introduction_points` with the round-robin
+loop it replaced, and with that loop's weighted variant, for services with
+10 to 10,000 instances.
+"""
+from __future__ import print_function
+
+import sys
+import random
+import timeit
+import argparse
+
+from onionbalance import descriptor
+
+
+def round_robin_allocation(ips_per_instance, num_slots):
+    """
+    Slot allocation loop previously used by choose_introduction_point_set
+    """
+    num_instances = len(ips_per_instance)
+    num_slots = min(num_slots, sum(ips_per_instance))
+    pos = 0
+    intro_selection = [0] * num_instances
+    while sum(intro_selection) < num_slots:
+        if ips_per_instance[pos] - intro_selection[pos] > 0:
+            intro_selection[pos] += 1
+        pos = (pos + 1) % num_instances
+    return intro_selection
+
+
+def weighted_round_robin_allocation(ips_per_instance, weights, num_slots):
+    """
+    Weighted slot allocation loop previously used by
+    choose_introduction_point_set
+    """
+    num_instances = len(ips_per_instance)
+    num_slots = min(num_slots, sum(ips_per_instance))
+    intro_selection = [0] * num_instances
+    while sum(intro_selection) < num_slots:
+        pos = min((pos for pos in range(num_instances)
+                   if ips_per_instance[pos] - intro_selection[pos] > 0),
+                  key=lambda pos: ((intro_selection[pos] + 1) /
+                                   float(weights[pos])))
+        intro_selection[pos] += 1
+    return intro_selection
+
+
+def parse_cmd_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--slots", type=int, default=10,
+                        help="Number of introduction point slots to fill "
+                        "(default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of timing runs, the fastest is "
+                        "reported (default: %(default)s)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_cmd_args()
+    rng = random.Random(0)
+
+    print("%10s %18s %18s %18s" % ("instances", "round-robin (ms)",
+                                   "weighted (ms)", "allocator (ms)"))
+    for num_instances in (10, 100, 1000, 10000):
+        # Most instances are offline or exhausted, as for a large service
+        # where only a few instances have published fresh descriptors
+        ips_per_instance = [rng.choice([0, 0, 0, 1, 3])
+                            for _ in range(num_instances)]
+        weights = [1] * num_instances
+
+        timings = []
+        for allocate in (
+                lambda: round_robin_allocation(ips_per_instance, args.slots),
+                lambda: weighted_round_robin_allocation(
+                    ips_per_instance, weights, args.slots),
+                lambda: descriptor.allocate_introduction_points(
+                    ips_per_instance, weights, args.slots)):
+            number = max(1, 10000 // num_instances)
+            best = min(timeit.repeat(allocate, number=number,
+                                     repeat=args.repeat))
+            timings.append(best / number * 1000)
+
+        print("%10d %18.3f %18.3f %18.3f" % ((num_instances,) +
+                                             tuple(timings)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -43,7 +43,6 @@ setup(
         'PyYAML>=3.11',
         'future>=0.14.0',
         'pycrypto>=2.6.1',
-        'schedule>=0.3.1',
         'setproctitle',
         'setuptools',
         'stem>=1.4.0-dev',
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from binascii import unhexlify
+
+import mock
+import pytest
+
+from onionbalance import consensus
+
+HSDIRS = ['1' * 40, '5' * 40, 'A' * 40, 'C' * 40, 'E' * 40]
+
+
+def router_statuses(fingerprints, flags=('HSDir',)):
+    return [mock.Mock(fingerprint=fingerprint, flags=list(flags))
+            for fingerprint in fingerprints]
+
+
+@pytest.mark.parametrize('descriptor_id, responsible_hsdirs', [
+    ('0' * 40, ['1' * 40, '5' * 40, 'A' * 40]),
+    ('6' * 40, ['A' * 40, 'C' * 40, 'E' * 40]),
+    ('B' * 40, ['C' * 40, 'E' * 40, '1' * 40]),
+    ('F' * 40, ['1' * 40, '5' * 40, 'A' * 40]),
+    # A descriptor ID equal to a fingerprint is stored on the following HSDirs
+    ('A' * 40, ['C' * 40, 'E' * 40, '1' * 40]),
+])
+def test_get_responsible_hsdirs(descriptor_id, responsible_hsdirs):
+    hsdir_ring = consensus.HSDirRing()
+    hsdir_ring.update(router_statuses(HSDIRS))
+    assert hsdir_ring.get_responsible_hsdirs(
+        unhexlify(descriptor_id)) == responsible_hsdirs
+
+
+def test_get_responsible_hsdirs_small_network():
+    hsdir_ring = consensus.HSDirRing()
+    assert hsdir_ring.get_responsible_hsdirs(unhexlify('6' * 40)) == []
+
+    hsdir_ring.update(router_statuses(HSDIRS[:2]))
+    assert hsdir_ring.get_responsible_hsdirs(
+        unhexlify('6' * 40)) == ['1' * 40, '5' * 40]
+
+
+def test_hsdir_ring_update():
+    """
+    Test that relays joining and leaving the consensus update the ring
+    """
+    hsdir_ring = consensus.HSDirRing()
+    hsdir_ring.update(router_statuses(HSDIRS) +
+                      router_statuses(['B' * 40], flags=['Fast']))
+    assert len(hsdir_ring) == 5
+
+    hsdir_ring.update(router_statuses(['0' * 40, '5' * 40, 'B' * 40,
+                                       'C' * 40, 'E' * 40]))
+    assert len(hsdir_ring) == 5
+    assert hsdir_ring.get_responsible_hsdirs(
+        unhexlify('6' * 40)) == ['B' * 40, 'C' * 40, 'E' * 40]
+    assert hsdir_ring.get_responsible_hsdirs(
+        unhexlify('F' * 40)) == ['0' * 40, '5' * 40, 'B' * 40]
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import os
+import signal
+import threading
+import time
+
+from onionbalance import eventloop
+
+
+def test_timers_run_in_deadline_order():
+    loop = eventloop.EventLoop()
+    calls = []
+    now = time.time()
+    loop.call_at(now + 0.02, lambda: calls.append('second'))
+    loop.call_at(now + 0.01, lambda: calls.append('first'))
+    cancelled = loop.call_at(now, lambda: calls.append('cancelled'))
+    cancelled.cancel()
+    repeating = loop.call_every(0.01, lambda: calls.append('repeat'),
+                                delay=0.03)
+
+    while calls.count('repeat') < 2:
+        loop.run_once()
+    repeating.cancel()
+
+    assert calls == ['first', 'second', 'repeat', 'repeat']
+    assert time.time() - now >= 0.04
+
+
+def test_events_from_other_threads_wake_the_loop():
+    loop = eventloop.EventLoop()
+    calls = []
+
+    thread = threading.Thread(
+        target=loop.call_soon_threadsafe, args=(calls.append, 'event'))
+    thread.start()
+    thread.join()
+
+    # The loop has no timers, it only wakes up for the posted event
+    loop.run_once()
+    assert calls == ['event']
+
+
+def test_deadline_sources():
+    loop = eventloop.EventLoop()
+    deadlines = [time.time() + 0.01]
+    calls = []
+
+    def run():
+        calls.append(deadlines.pop())
+    loop.add_deadline_source(lambda: deadlines[0] if deadlines else None,
+                             run)
+    loop.call_later(0.05, loop.stop)
+    loop.run_forever()
+
+    assert len(calls) == 1
+
+
+def test_signal_handlers_run_on_the_loop():
+    loop = eventloop.EventLoop()
+    calls = []
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        loop.add_signal_handler(signal.SIGUSR1, lambda: calls.append('hup'))
+        os.kill(os.getpid(), signal.SIGUSR1)
+        loop.run_once()
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+    assert calls == ['hup']
+
+
+def test_signal_handler_stops_the_loop():
+    """
+    Test that a signal can stop the loop once it has finished its work
+    """
+    loop = eventloop.EventLoop()
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        loop.add_signal_handler(signal.SIGUSR1, loop.stop)
+        loop.call_soon_threadsafe(os.kill, os.getpid(), signal.SIGUSR1)
+        loop.run_forever()
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
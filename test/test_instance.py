@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import mock
+import pytest
+
+from onionbalance import instance
+
+
+def test_fetch_tracker_round_complete():
+    """
+    Test that a refresh round finishes once all fetches have responded
+    """
+    tracker = instance.FetchTracker()
+    tracker.start_round()
+    tracker.dispatched('descid1', 'aaaaaaaaaaaaaaaa')
+    tracker.dispatched('descid2', 'aaaaaaaaaaaaaaaa')
+    tracker.dispatched('bbbbbbbbbbbbbbbb', 'bbbbbbbbbbbbbbbb')
+    assert tracker.is_outstanding('aaaaaaaaaaaaaaaa')
+    assert not tracker.round_complete()
+
+    assert (tracker.response_received(['descid1', 'aaaaaaaaaaaaaaaa']) ==
+            'aaaaaaaaaaaaaaaa')
+    assert tracker.is_outstanding('aaaaaaaaaaaaaaaa')
+    assert tracker.response_received(['descid2', None])
+    assert not tracker.is_outstanding('aaaaaaaaaaaaaaaa')
+    assert not tracker.round_complete()
+
+    # Untargeted fetches are matched by the onion address
+    assert tracker.response_received(['descid3', 'bbbbbbbbbbbbbbbb'],
+                                     succeeded=False)
+    assert tracker.round_complete()
+
+    # Responses for requests which are not outstanding are ignored
+    assert not tracker.response_received(['descid1', 'aaaaaaaaaaaaaaaa'])
+
+
+def test_fetch_tracker_expires_old_requests(mocker):
+    """
+    Test that requests which never received a response are expired
+    """
+    tracker = instance.FetchTracker()
+    mocker.patch('onionbalance.instance.time.time', return_value=1000)
+    tracker.dispatched('aaaaaaaaaaaaaaaa', 'aaaaaaaaaaaaaaaa')
+
+    mocker.patch('onionbalance.instance.time.time', return_value=1000 + 3600)
+    tracker.start_round()
+    assert tracker.round_complete()
+
+
+def test_fetch_tracker_completed_callback():
+    """
+    Test that the callback runs once all requests for an address finish
+    """
+    completed = []
+    tracker = instance.FetchTracker(
+        completed_callback=lambda *args: completed.append(args))
+    tracker.dispatched('descid1', 'aaaaaaaaaaaaaaaa')
+    tracker.dispatched('descid2', 'aaaaaaaaaaaaaaaa')
+
+    tracker.response_received(['descid1'], succeeded=False)
+    assert completed == []
+    tracker.response_received(['descid2'])
+    assert completed == [('aaaaaaaaaaaaaaaa', True)]
+
+
+def test_fetch_not_dispatched_completes(mocker):
+    """
+    Test that a fetch which could not be dispatched finishes through the
+    completion callback
+    """
+    completed = []
+    tracker = instance.FetchTracker(
+        completed_callback=lambda *args: completed.append(args))
+    mocker.patch.object(instance, 'fetch_tracker', tracker)
+    test_instance = mock.Mock(onion_address='aaaaaaaaaaaaaaaa', next_fetch=0)
+    test_instance.fetch_descriptor.return_value = []
+    mocker.patch('onionbalance.config.services',
+                 [mock.Mock(instances=[test_instance])])
+
+    instance.fetch_instance_descriptors(None)
+    assert completed == [('aaaaaaaaaaaaaaaa', False)]
+    assert not tracker.is_outstanding('aaaaaaaaaaaaaaaa')
+
+
+def test_schedule_next_fetch_backoff(mocker):
+    """
+    Test that instances which keep failing are fetched less often
+    """
+    mocker.patch.multiple('onionbalance.config', REFRESH_INTERVAL=600,
+                          MIN_REFRESH_INTERVAL=60, MAX_REFRESH_INTERVAL=1800)
+    test_instance = instance.Instance(None, 'aaaaaaaaaaaaaaaa')
+    mocker.patch('onionbalance.instance.time.time', return_value=1000)
+
+    intervals = []
+    for _ in range(4):
+        test_instance.fetch_completed(succeeded=False)
+        intervals.append(test_instance.next_fetch - 1000)
+    assert intervals == [600, 1200, 1800, 1800]
+
+    test_instance.fetch_completed(succeeded=True)
+    assert test_instance.next_fetch - 1000 == 600
+
+
+def test_schedule_next_fetch_expected_republish(mocker):
+    """
+    Test that instances are fetched soon after their expected republish
+    """
+    mocker.patch.multiple('onionbalance.config', REFRESH_INTERVAL=600,
+                          MIN_REFRESH_INTERVAL=60, MAX_REFRESH_INTERVAL=1800)
+    test_instance = instance.Instance(None, 'aaaaaaaaaaaaaaaa')
+
+    # The instance was seen to change twice, 300 seconds apart
+    test_instance._descriptor_changed(now=1000)
+    test_instance._descriptor_changed(now=1300)
+    assert test_instance.publish_interval == 300
+    assert test_instance.next_fetch == 1300 + 300 + 60
+
+    # Once overdue, the default refresh interval is used
+    test_instance.schedule_next_fetch(now=2000)
+    assert test_instance.next_fetch == 2000 + 600
+
+
+def test_decode_introduction_points_cached(mocker):
+    """
+    Test that decoded introduction points are reused until the cookie changes
+    """
+    parsed_descriptor = mocker.Mock(introduction_points_encoded='encoded')
+    parsed_descriptor.introduction_points.return_value = ['IP']
+    test_instance = instance.Instance(None, 'aaaaaaaaaaaaaaaa',
+                                      authentication_cookie='cookie')
+
+    for _ in range(2):
+        introduction_points = test_instance.decode_introduction_points(
+            parsed_descriptor)
+        assert introduction_points == ['IP']
+    assert parsed_descriptor.introduction_points.call_count == 1
+
+    test_instance.authentication_cookie = 'new-cookie'
+    test_instance.decode_introduction_points(parsed_descriptor)
+    assert parsed_descriptor.introduction_points.call_count == 2
+    parsed_descriptor.introduction_points.assert_called_with(
+        authentication_cookie='new-cookie')
+
+
+def test_instance_weight_from_load_report(tmpdir, mocker):
+    mocker.patch('onionbalance.config.LOAD_WEIGHT_FLOOR', 0.1)
+    load_report = tmpdir.join('load.yaml')
+    test_instance = instance.Instance(
+        None, 'aaaaaaaaaaaaaaaa', weight=2, load_report=str(load_report))
+
+    # A missing report leaves the configured weight
+    assert test_instance.get_weight() == 2
+
+    load_report.write('cpu: 0.25\n'
+                      'rendezvous_circuits: 50\n'
+                      'max_rendezvous_circuits: 100\n')
+    assert test_instance.get_load() == 0.5
+    assert test_instance.get_weight() == 1
+
+    load_report.write('cpu: 1.5\n')
+    assert test_instance.get_weight() == pytest.approx(0.2)
+
+    # Stale reports are ignored
+    assert test_instance.get_weight(now=load_report.mtime() + 3600) == 2
+
+
+def test_instance_missing_load_report_logged_once(tmpdir, mocker):
+    warning = mocker.patch('onionbalance.instance.logger.warning')
+    load_report = tmpdir.join('load.yaml')
+    test_instance = instance.Instance(
+        None, 'aaaaaaaaaaaaaaaa', load_report=str(load_report))
+
+    assert test_instance.get_load() is None
+    assert test_instance.get_load() is None
+    assert warning.call_count == 1
+    assert 'exc_info' not in warning.call_args[1]
+
+    # The warning is repeated if the report disappears again
+    load_report.write('cpu: 0.5\n')
+    assert test_instance.get_load() == 0.5
+    load_report.remove()
+    assert test_instance.get_load() is None
+    assert warning.call_count == 2
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from onionbalance import metrics
+
+
+def test_counter_and_histogram_render():
+    registry = metrics.MetricsRegistry()
+    counter = registry.register(metrics.Counter(
+        'test_fetches', "Fetches", ('instance', 'result')))
+    histogram = registry.register(metrics.Histogram(
+        'test_seconds', "Durations", buckets=(0.1, 1)))
+
+    counter.inc(instance='aaaaaaaaaaaaaaaa', result='failed')
+    counter.inc(2, instance='aaaaaaaaaaaaaaaa', result='failed')
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    lines = registry.render().splitlines()
+    assert lines == [
+        '# HELP test_fetches Fetches',
+        '# TYPE test_fetches counter',
+        'test_fetches_total{instance="aaaaaaaaaaaaaaaa",result="failed"} 3.0',
+        '# HELP test_seconds Durations',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 1.0',
+        'test_seconds_bucket{le="1.0"} 2.0',
+        'test_seconds_bucket{le="+Inf"} 3.0',
+        'test_seconds_count 3.0',
+        'test_seconds_sum 5.55',
+        '# EOF',
+    ]
+
+
+def test_gauge_collect_escapes_labels():
+    gauge = metrics.Gauge('test_gauge', "Gauge", ('service',),
+                          collect=lambda: [({'service': 'a"b\n'}, 1)])
+    assert gauge.samples() == [('test_gauge', [('service', 'a"b\n')], 1)]
+    assert gauge.render()[-1] == 'test_gauge{service="a\\"b\\n"} 1.0'
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import mock
+
+from onionbalance.registry import ServiceRegistry
+
+
+def test_service_registry_instance_index():
+    """
+    Test that the address index follows added and removed services
+    """
+    shared_a = mock.Mock(onion_address='aaaaaaaaaaaaaaaa')
+    shared_b = mock.Mock(onion_address='aaaaaaaaaaaaaaaa')
+    other = mock.Mock(onion_address='bbbbbbbbbbbbbbbb')
+    service_a = mock.Mock(instances=[shared_a, other])
+    service_b = mock.Mock(instances=[shared_b])
+
+    registry = ServiceRegistry()
+    registry.append(service_a)
+    registry.append(service_b)
+    assert list(registry) == [service_a, service_b]
+    assert registry.get_instances('aaaaaaaaaaaaaaaa') == [shared_a, shared_b]
+
+    registry.remove(service_a)
+    assert registry.get_instances('aaaaaaaaaaaaaaaa') == [shared_b]
+    assert registry.get_instances('bbbbbbbbbbbbbbbb') == []
+
+    registry.remove_instance(service_b, shared_b)
+    assert service_b.instances == []
+    assert registry.get_instances('aaaaaaaaaaaaaaaa') == []
+
+    registry.add_instance(service_b, other)
+    assert registry.get_instances('bbbbbbbbbbbbbbbb') == [other]
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+import datetime
+import multiprocessing
+
+import mock
+
+from onionbalance import service
+from onionbalance import util
+
+from .test_descriptor import PEM_PRIVATE_KEY, PRIVATE_KEY
+
+
+def test_publish_scheduler_runs_due_services(mocker):
+    """
+    Test that only services past their deadline are published and that
+    they are rescheduled
+    """
+    publish = mocker.patch('onionbalance.service.publish_descriptors')
+    mocker.patch('onionbalance.service.time.time', return_value=1000)
+    service_a, service_b = mock.Mock(), mock.Mock()
+
+    scheduler = service.PublishScheduler()
+    scheduler.add(service_a, delay=10)
+    scheduler.add(service_b, delay=100)
+    assert scheduler.next_deadline() == 1010
+
+    scheduler.run_pending(now=1050)
+    publish.assert_called_once_with([service_a])
+    assert scheduler.queue_depth == 1
+    assert scheduler.last_lateness == 40
+    assert len(scheduler) == 2
+
+    # The published service was rescheduled within the jittered interval
+    assert scheduler.next_deadline() == 1100
+    scheduler.remove(service_b)
+    assert 1000 + 150 <= scheduler.next_deadline() <= 1000 + 450
+
+
+def test_publish_scheduler_remove(mocker):
+    publish = mocker.patch('onionbalance.service.publish_descriptors')
+    test_service = mock.Mock()
+    scheduler = service.PublishScheduler()
+    scheduler.add(test_service)
+    scheduler.remove(test_service)
+
+    assert scheduler.next_deadline() is None
+    scheduler.run_pending()
+    assert not publish.called
+
+
+def test_publish_scheduler_warm_up(mocker):
+    """
+    Test that a service is published as soon as all of its instances have
+    been fetched, rather than waiting for the warm-up timeout
+    """
+    mocker.patch('onionbalance.service.time.time', return_value=1000)
+    instances = [mock.Mock(onion_address='aaaaaaaaaaaaaaaa',
+                           fetch_attempted=False),
+                 mock.Mock(onion_address='bbbbbbbbbbbbbbbb',
+                           fetch_attempted=False)]
+    test_service = mock.Mock(instances=instances)
+    restored_service = mock.Mock(instances=[mock.Mock(
+        onion_address='cccccccccccccccc', fetch_attempted=False)])
+    restored_service.instances[0].get_state.return_value = 'online'
+
+    scheduler = service.PublishScheduler()
+    scheduler.warm_up(test_service, timeout=15)
+    assert scheduler.next_deadline() == 1015
+
+    # A service whose instances were restored online is published at once
+    scheduler.warm_up(restored_service, timeout=15)
+    assert scheduler.next_deadline() == 1000
+    scheduler.remove(restored_service)
+
+    scheduler.instance_fetched('aaaaaaaaaaaaaaaa')
+    scheduler.instance_fetched('dddddddddddddddd')
+    assert scheduler.next_deadline() == 1015
+
+    scheduler.instance_fetched('bbbbbbbbbbbbbbbb')
+    assert scheduler.next_deadline() == 1000
+    assert not scheduler._warming_up
+    assert not scheduler._warming_up_by_address
+
+
+def test_service_ready_after_first_upload(mocker):
+    """
+    Test that a service becomes ready once Tor accepts one of its
+    descriptors, and not when the upload is rejected
+    """
+    mocker.patch('onionbalance.service.consensus.hsdir_ring')
+    mocker.patch('onionbalance.service.upload.upload_tracker')
+    mocker.patch('onionbalance.service.state.state_store')
+    upload_descriptors = mocker.patch(
+        'onionbalance.service.descriptor.upload_descriptors')
+    test_service = mock.Mock(onion_address='aaaaaaaaaaaaaaaa', ready=False)
+    job = service.DescriptorJob(test_service, 0, 0, b'id-0',
+                                datetime.datetime(2026, 1, 1), [])
+    job.signed_descriptor = 'signed'
+
+    upload_descriptors.return_value = [ValueError('rejected')]
+    service.Service.upload_descriptors(test_service, [job])
+    assert test_service.ready is False
+
+    upload_descriptors.return_value = [None]
+    service.Service.upload_descriptors(test_service, [job])
+    assert test_service.ready is True
+
+
+class SynchronousPool(object):
+    """
+    Signing worker which runs each task when its result is requested
+    """
+
+    def apply_async(self, func, args):
+        result = mock.Mock()
+        result.get.side_effect = lambda timeout: func(*args)
+        return result
+
+
+def make_job(signed=None):
+    test_service = mock.Mock(onion_address='aaaaaaaaaaaaaaaa')
+    test_service.get_cached_descriptor.return_value = signed
+    test_service.generate_descriptor.return_value = 'signed in process'
+    return service.DescriptorJob(test_service, 0, 0, b'descriptor-id',
+                                 datetime.datetime(2026, 1, 1), [])
+
+
+def test_sign_descriptors_in_process(mocker):
+    mocker.patch.dict('onionbalance.service.signing_workers', clear=True)
+    cached, job = make_job(signed='cached'), make_job()
+
+    service.sign_descriptors([cached, job])
+
+    assert cached.signed_descriptor == 'cached'
+    assert not cached.service.generate_descriptor.called
+    assert job.signed_descriptor == 'signed in process'
+    job.service.cache_descriptor.assert_called_once_with(job)
+
+
+def test_sign_descriptors_in_worker(mocker):
+    mocker.patch.dict('onionbalance.service.signing_workers',
+                      {'aaaaaaaaaaaaaaaa': SynchronousPool()})
+    mocker.patch('onionbalance.service._worker_key', ('key', 'template'))
+    generate = mocker.patch(
+        'onionbalance.service.descriptor.generate_service_descriptor',
+        return_value='signed in worker')
+    job = make_job()
+
+    service.sign_descriptors([job])
+
+    assert job.signed_descriptor == 'signed in worker'
+    assert generate.call_args[0][0] == 'key'
+    assert generate.call_args[1]['template'] == 'template'
+    assert not job.service.generate_descriptor.called
+
+
+def test_sign_descriptors_worker_failure_falls_back(mocker):
+    """
+    Test that descriptors are signed in process when a worker times out or
+    does not have the service's key, and that the workers share a deadline
+    """
+    clock = [1000.0]
+    mocker.patch('onionbalance.service.time.time', lambda: clock[0])
+    mocker.patch('onionbalance.config.SIGNING_TIMEOUT', 30)
+    timeouts = []
+
+    def hang(timeout):
+        timeouts.append(timeout)
+        clock[0] += timeout
+        raise multiprocessing.TimeoutError()
+    worker = mock.Mock()
+    worker.apply_async.return_value.get.side_effect = hang
+    mocker.patch.dict('onionbalance.service.signing_workers',
+                      {'aaaaaaaaaaaaaaaa': worker})
+    jobs = [make_job(), make_job()]
+    service.sign_descriptors(jobs)
+    assert [job.signed_descriptor for job in jobs] == ['signed in process'] * 2
+    assert timeouts == [30, 0]
+
+    mocker.patch.dict('onionbalance.service.signing_workers',
+                      {'aaaaaaaaaaaaaaaa': SynchronousPool()})
+    mocker.patch('onionbalance.service._worker_key', None)
+    job = make_job()
+    service.sign_descriptors([job])
+    assert job.signed_descriptor == 'signed in process'
+
+
+def test_signing_worker_loads_own_key(mocker, tmpdir):
+    """
+    Test that a signing worker loads its service's key from the key file,
+    and that encrypted keys are not loaded in a worker
+    """
+    mocker.patch('onionbalance.service._worker_key', None)
+    key_path = tmpdir.join('private_key')
+    key_path.write(PEM_PRIVATE_KEY)
+    onion_address = util.calc_onion_address(PRIVATE_KEY)
+
+    service._init_signing_worker(str(key_path), 'bbbbbbbbbbbbbbbb')
+    assert service._worker_key is None
+    service._init_signing_worker(str(key_path), onion_address)
+    assert service._worker_key[1].onion_address == onion_address
+
+    assert service._can_load_key_in_worker(str(key_path))
+    key_path.write(PEM_PRIVATE_KEY.replace(
+        'KEY-----\n', 'KEY-----\nProc-Type: 4,ENCRYPTED\n', 1))
+    assert not service._can_load_key_in_worker(str(key_path))
+    assert not service._can_load_key_in_worker(None)
+
+
+def test_signed_descriptor_cache():
+    """
+    Test that a signed descriptor is reused until its introduction points,
+    replica, descriptor ID or hour of publication change
+    """
+    # Only the cache state of the service is needed
+    test_service = mock.Mock(onion_address='aaaaaaaaaaaaaaaa',
+                             _signed_descriptors=util.LRUCache(8))
+    ips = [mock.Mock(identifier='a'), mock.Mock(identifier='b')]
+    published = datetime.datetime(2026, 1, 1, 10, 5)
+
+    job = service.DescriptorJob(test_service, 0, 0, b'id-0', published, ips)
+    job.signed_descriptor = 'signed'
+    service.Service.cache_descriptor(test_service, job)
+
+    def cached(replica=0, descriptor_id=b'id-0', timestamp=published,
+               introduction_points=ips):
+        return service.Service.get_cached_descriptor(
+            test_service, service.DescriptorJob(
+                test_service, replica, 0, descriptor_id, timestamp,
+                introduction_points))
+
+    # The same introduction points in a different order, later in the hour
+    assert cached(introduction_points=ips[::-1],
+                  timestamp=published.replace(minute=55)) == 'signed'
+
+    assert cached(introduction_points=ips[:1]) is None
+    assert cached(replica=1) is None
+    assert cached(descriptor_id=b'id-1') is None
+    assert cached(timestamp=published.replace(hour=11)) is None
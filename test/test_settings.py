@@ -2,9 +2,14 @@
 import io
 import os
 
+import mock
 import pytest
 
+from onionbalance import config
+from onionbalance import descriptor
+from onionbalance import registry
 from onionbalance import settings
+from onionbalance import util
 from .util import builtin
 
 CONFIG_FILE_VALID = u'\n'.join([
@@ -48,3 +53,150 @@ def test_parse_config_file_valid(mocker):
 def test_parse_config_file_does_not_exist(mocker):
     with pytest.raises(SystemExit):
         settings.parse_config_file('doesnotexist/config.yaml')
+
+
+def make_service(controller, service_key, instances, key_path):
+    return mock.Mock(onion_address=service_key, instances=instances,
+                     key_path=key_path)
+
+
+def test_reload_services(mocker):
+    """
+    Test that a reloaded config only adds and removes the changed services
+    and instances
+    """
+    mocker.patch.object(config, 'services', registry.ServiceRegistry())
+    mocker.patch('onionbalance.settings.load_service_key',
+                 side_effect=lambda key_path, prompt: key_path)
+    mocker.patch('onionbalance.settings.util.calc_onion_address',
+                 side_effect=lambda service_key: service_key)
+    mocker.patch('onionbalance.service.Service', side_effect=make_service)
+    scheduler = mocker.patch('onionbalance.service.publish_scheduler')
+    mocker.patch('onionbalance.state.state_store')
+
+    assert settings.reload_services(None, [
+        {'key': 'aaaaaaaaaaaaaaaa', 'instances': [
+            {'address': 'xxxxxxxxxxxxxxxx'}, {'address': 'yyyyyyyyyyyyyyyy'}]},
+        {'key': 'bbbbbbbbbbbbbbbb', 'instances': [
+            {'address': 'zzzzzzzzzzzzzzzz'}]},
+    ])
+    service_a, service_b = config.services
+    kept = service_a.instances[0]
+    kept.introduction_points = ['ip']
+
+    scheduler.reset_mock()
+    assert settings.reload_services(None, [
+        {'key': 'aaaaaaaaaaaaaaaa', 'instances': [
+            {'address': 'xxxxxxxxxxxxxxxx'},
+            {'address': 'yyyyyyyyyyyyyyyy', 'weight': 2},
+            {'address': 'wwwwwwwwwwwwwwww'}]},
+    ])
+
+    assert list(config.services) == [service_a]
+    scheduler.remove.assert_called_once_with(service_b)
+    scheduler.warm_up.assert_called_once_with(service_a,
+                                              config.WARMUP_TIMEOUT)
+    assert [i.onion_address for i in service_a.instances] == [
+        'xxxxxxxxxxxxxxxx', 'yyyyyyyyyyyyyyyy', 'wwwwwwwwwwwwwwww']
+    assert service_a.instances[0] is kept
+    assert kept.introduction_points == ['ip']
+    assert service_a.instances[1].weight == 2
+    assert service_a.instances_changed
+    assert config.services.get_instances('zzzzzzzzzzzzzzzz') == []
+
+    # An invalid config leaves the running services unchanged
+    assert not settings.reload_services(None, [
+        {'key': 'aaaaaaaaaaaaaaaa', 'instances': [
+            {'address': 'xxxxxxxxxxxxxxxx', 'weight': -1}]},
+    ])
+    assert len(service_a.instances) == 3
+
+
+def test_reload_services_parses_cached_descriptors_for_new_instances(mocker):
+    """
+    Test that descriptors already received for an instance address are
+    parsed again for an instance added by a reload
+    """
+    mocker.patch.object(config, 'services', registry.ServiceRegistry())
+    mocker.patch('onionbalance.settings.load_service_key',
+                 side_effect=lambda key_path, prompt: key_path)
+    mocker.patch('onionbalance.settings.util.calc_onion_address',
+                 side_effect=lambda service_key: service_key)
+    mocker.patch('onionbalance.service.Service', side_effect=make_service)
+    mocker.patch('onionbalance.service.publish_scheduler')
+    mocker.patch('onionbalance.state.state_store')
+    cache = mocker.patch.object(descriptor, 'received_descriptor_cache',
+                                util.LRUCache(10))
+
+    settings.reload_services(None, [
+        {'key': 'aaaaaaaaaaaaaaaa', 'instances': [
+            {'address': 'xxxxxxxxxxxxxxxx'}]}])
+    cache.set(b'digest-x', 'xxxxxxxxxxxxxxxx')
+    cache.set(b'digest-w', 'wwwwwwwwwwwwwwww')
+
+    settings.reload_services(None, [
+        {'key': 'aaaaaaaaaaaaaaaa', 'instances': [
+            {'address': 'xxxxxxxxxxxxxxxx'},
+            {'address': 'wwwwwwwwwwwwwwww'}]}])
+    assert cache.get(b'digest-x') == 'xxxxxxxxxxxxxxxx'
+    assert cache.get(b'digest-w') is None
+
+    # A cached copy which was already queued does not mark the new
+    # instance as online without a descriptor
+    new_instance = config.services[0].instances[1]
+    descriptor.apply_descriptor(
+        descriptor.ParsedDescriptor('wwwwwwwwwwwwwwww'))
+    assert new_instance.received is None
+    assert new_instance.get_state() == 'offline'
+
+
+def test_load_service_key_reloads_replaced_key(mocker, tmpdir):
+    mocker.patch.dict(settings.loaded_keys, clear=True)
+    key_decrypt_prompt = mocker.patch(
+        'onionbalance.settings.util.key_decrypt_prompt',
+        side_effect=['old key', 'new key'])
+    key_file = tmpdir.join('private.key')
+    key_file.write('old')
+
+    assert settings.load_service_key(str(key_file)) == 'old key'
+    assert settings.load_service_key(str(key_file)) == 'old key'
+    assert key_decrypt_prompt.call_count == 1
+
+    replacement = tmpdir.join('private.key.new')
+    replacement.write('replaced')
+    replacement.rename(key_file)
+    assert settings.load_service_key(str(key_file)) == 'new key'
+
+    with pytest.raises(ValueError):
+        settings.load_service_key(str(tmpdir.join('missing.key')))
+
+
+def test_reload_services_refuses_encrypted_key(mocker, tmpdir):
+    """
+    Test that a reload never prompts for the passphrase of a changed
+    encrypted key and keeps the running services instead
+    """
+    mocker.patch.dict(settings.loaded_keys, clear=True)
+    mocker.patch.object(config, 'services', registry.ServiceRegistry())
+    key_decrypt_prompt = mocker.patch(
+        'onionbalance.settings.util.key_decrypt_prompt',
+        return_value='aaaaaaaaaaaaaaaa')
+    mocker.patch('onionbalance.settings.util.calc_onion_address',
+                 side_effect=lambda service_key: service_key)
+    mocker.patch('onionbalance.service.Service', side_effect=make_service)
+    mocker.patch('onionbalance.service.publish_scheduler')
+    mocker.patch('onionbalance.state.state_store')
+    key_file = tmpdir.join('private.key')
+    key_file.write('unencrypted')
+    services_config = [{'key': str(key_file), 'instances': [
+        {'address': 'xxxxxxxxxxxxxxxx'}]}]
+
+    assert settings.reload_services(None, services_config)
+    running = list(config.services)
+
+    key_file.write('Proc-Type: 4,ENCRYPTED\nchanged')
+    services_config[0]['instances'].append({'address': 'yyyyyyyyyyyyyyyy'})
+    assert not settings.reload_services(None, services_config)
+    assert key_decrypt_prompt.call_count == 1
+    assert list(config.services) == running
+    assert len(running[0].instances) == 1
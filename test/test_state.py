@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+
+import mock
+import stem.descriptor.hidden_service_descriptor
+
+from onionbalance import config
+from onionbalance import instance
+from onionbalance import registry
+from onionbalance import state
+from onionbalance import util
+
+from .test_descriptor import PRIVATE_KEY, SIGNED_DESCRIPTOR
+
+ONION_ADDRESS = util.calc_onion_address(PRIVATE_KEY)
+
+
+def make_services(mocker, uploaded=None):
+    """
+    Register a service with one instance using the test descriptor's key
+    """
+    test_instance = instance.Instance(None, ONION_ADDRESS)
+    mocker.patch.object(test_instance, 'decode_introduction_points',
+                        return_value=[mock.Mock(identifier='ip')])
+    services = registry.ServiceRegistry()
+    services.append(mock.Mock(onion_address='aaaaaaaaaaaaaaaa',
+                              uploaded=uploaded, instances=[test_instance]))
+    mocker.patch.object(config, 'services', services)
+    return services
+
+
+def test_state_save_and_load(mocker, tmpdir):
+    """
+    Test that a saved descriptor is validated and restored at startup
+    """
+    path = str(tmpdir.join('state.json'))
+    parsed_descriptor = stem.descriptor.hidden_service_descriptor.\
+        HiddenServiceDescriptor(SIGNED_DESCRIPTOR.encode('utf-8'))
+    received = parsed_descriptor.published + datetime.timedelta(minutes=5)
+    uploaded = received + datetime.timedelta(minutes=1)
+
+    services = make_services(mocker, uploaded=uploaded)
+    saved_instance = services[0].instances[0]
+    saved_instance.update_descriptor(parsed_descriptor)
+    saved_instance.received = received
+    state.StateStore().save(path)
+
+    saved = json.loads(tmpdir.join('state.json').read())
+    assert list(saved['instances']) == [ONION_ADDRESS]
+
+    services = make_services(mocker)
+    restored_instance = services[0].instances[0]
+    store = state.StateStore()
+    now = received + datetime.timedelta(minutes=10)
+    assert store.load(path, now=now) == 1
+
+    assert restored_instance.timestamp == parsed_descriptor.published
+    assert restored_instance.received == received
+    assert restored_instance.changed_since_published
+    assert restored_instance.get_state(now) == 'online'
+    assert restored_instance.next_fetch == 0
+    assert services[0].uploaded == uploaded
+    assert store.next_deadline() is None
+
+
+def test_state_load_rejects_old_descriptor(mocker, tmpdir):
+    path = str(tmpdir.join('state.json'))
+    parsed_descriptor = stem.descriptor.hidden_service_descriptor.\
+        HiddenServiceDescriptor(SIGNED_DESCRIPTOR.encode('utf-8'))
+
+    services = make_services(mocker)
+    services[0].instances[0].update_descriptor(parsed_descriptor)
+    services[0].instances[0].received = parsed_descriptor.published
+    state.StateStore().save(path)
+
+    services = make_services(mocker)
+    now = parsed_descriptor.published + datetime.timedelta(hours=5)
+    assert state.StateStore().load(path, now=now) == 0
+    assert services[0].instances[0].received is None
+
+
+def test_state_load_rejects_tampered_descriptor(mocker, tmpdir):
+    path = tmpdir.join('state.json')
+    path.write(json.dumps({
+        'version': state.STATE_VERSION,
+        'instances': {ONION_ADDRESS: {
+            'descriptor': SIGNED_DESCRIPTOR.replace(
+                'secret-id-part u', 'secret-id-part v'),
+            'received': 0}}}))
+
+    services = make_services(mocker)
+    assert state.StateStore().load(str(path)) == 0
+    assert services[0].instances[0].received is None
+
+
+def test_state_load_skips_invalid_received_time(mocker, tmpdir):
+    path = tmpdir.join('state.json')
+    for received in (None, 'yesterday'):
+        path.write(json.dumps({
+            'version': state.STATE_VERSION,
+            'services': {'aaaaaaaaaaaaaaaa': {'uploaded': received}},
+            'instances': {ONION_ADDRESS: {'descriptor': SIGNED_DESCRIPTOR,
+                                          'received': received}}}))
+
+        services = make_services(mocker)
+        assert state.StateStore().load(str(path)) == 0
+        assert services[0].instances[0].received is None
+        assert services[0].uploaded is None
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import socket
+
+import mock
+
+from onionbalance import registry
+from onionbalance import status
+
+
+def make_instance(onion_address, received=True):
+    now = datetime.datetime.utcnow()
+    instance = mock.Mock(onion_address=onion_address, weight=1,
+                         fetch_failures=0, next_fetch=0,
+                         introduction_points=['ip'] * 3 if received else [],
+                         received=now if received else None,
+                         timestamp=now if received else None)
+    instance.get_state.return_value = 'online' if received else 'offline'
+    return instance
+
+
+def make_status_socket(tmpdir):
+    services = registry.ServiceRegistry()
+    services.append(mock.Mock(
+        onion_address='aaaaaaaaaaaaaaaa', uploaded=None, ready=False,
+        intro_point_fanout=3, intro_point_churn=(3, 0),
+        instances=[make_instance('bbbbbbbbbbbbbbbb'),
+                   make_instance('cccccccccccccccc', received=False)]))
+    config = mock.Mock(services=services,
+                       CONTROL_SOCKET_LOCATION=str(tmpdir.join('control')))
+    return status.StatusSocket(config)
+
+
+def read_all(status_socket, client):
+    data = b''
+    for _ in range(20):
+        status_socket.listen_with_timeout(timeout=0.1)
+        try:
+            chunk = client.recv(65536)
+        except socket.error:
+            continue
+        if not chunk:
+            break
+        data += chunk
+    return data.decode()
+
+
+def test_status_socket_json_commands(tmpdir):
+    status_socket = make_status_socket(tmpdir)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(status_socket._unix_socket_fname)
+    client.setblocking(False)
+
+    client.sendall(b'{"command": "dump", "state": "offline"}\n'
+                   b'{"command": "instance", "address": "bbbbbbbbbbbbbbbb"}\n'
+                   b'{"command": "service", "address": "unknown"}\n')
+    client.shutdown(socket.SHUT_WR)
+    dump, instance, error = [json.loads(line) for line
+                             in read_all(status_socket, client).splitlines()]
+
+    service, = dump['services']
+    assert service['address'] == 'aaaaaaaaaaaaaaaa'
+    assert [i['address'] for i in service['instances']] == [
+        'cccccccccccccccc']
+    assert instance['instances'][0]['intro_points'] == 3
+    assert error == {'error': 'Unknown service.'}
+    status_socket.close()
+
+
+def test_status_socket_legacy_summary(tmpdir):
+    status_socket = make_status_socket(tmpdir)
+
+    # A client which is not reading does not block other clients
+    stuck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stuck.connect(status_socket._unix_socket_fname)
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(status_socket._unix_socket_fname)
+    client.setblocking(False)
+    summary = read_all(status_socket, client)
+
+    assert summary.startswith('aaaaaaaaaaaaaaaa.onion None')
+    assert '  cccccccccccccccc.onion [offline]\n' in summary
+    stuck.close()
+    status_socket.close()
+
+
+def test_status_socket_ready_command(tmpdir):
+    status_socket = make_status_socket(tmpdir)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(status_socket._unix_socket_fname)
+    client.setblocking(False)
+
+    client.sendall(b'{"command": "ready"}\n')
+    client.shutdown(socket.SHUT_WR)
+    readiness = json.loads(read_all(status_socket, client))
+
+    assert readiness == {'ready': False,
+                         'services': {'aaaaaaaaaaaaaaaa': False}}
+    status_socket.close()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import mock
+import stem
+
+from onionbalance import eventhandler
+from onionbalance import instance
+from onionbalance import upload
+from onionbalance import util
+
+HSDIR_A = 'A' * 40
+HSDIR_B = 'B' * 40
+
+
+def test_upload_tracker_correlates_events():
+    """
+    Test that UPLOADED and FAILED events are matched to the uploaded
+    descriptor through the HSDir of the preceding UPLOAD event
+    """
+    service = mock.Mock(onion_address='aaaaaaaaaaaaaaaa')
+    tracker = upload.UploadTracker()
+    tracker.expect(service, 0, 0, b'descriptor-id-0', 'signed',
+                   [HSDIR_A, HSDIR_B])
+    descriptor_id = util.base32_encode_str(b'descriptor-id-0')
+
+    tracker.upload_started(descriptor_id, HSDIR_A)
+    tracker.upload_started(descriptor_id, HSDIR_B)
+    assert tracker.upload_finished(HSDIR_A, succeeded=True)
+    assert tracker.upload_finished(HSDIR_B, succeeded=False)
+    assert not tracker.upload_finished(HSDIR_B, succeeded=True)
+
+    descriptor_upload, = tracker.get_uploads(service)
+    assert descriptor_upload.confirmed == [HSDIR_A]
+    assert descriptor_upload.failed == [HSDIR_B]
+    assert tracker.get_failed_uploads() == [descriptor_upload]
+
+    # Only the failed HSDir is retried
+    assert tracker.start_retry(descriptor_upload) == [HSDIR_B]
+    assert tracker.get_failed_uploads() == []
+
+
+def test_upload_tracker_replaces_superseded_uploads():
+    service = mock.Mock(onion_address='aaaaaaaaaaaaaaaa')
+    tracker = upload.UploadTracker()
+    tracker.expect(service, 0, 0, b'descriptor-id-0', 'old', [HSDIR_A])
+    tracker.expect(service, 0, 0, b'descriptor-id-1', 'new', [HSDIR_A])
+
+    descriptor_upload, = tracker.get_uploads(service)
+    assert descriptor_upload.signed_descriptor == 'new'
+    assert tracker.get_upload(b'descriptor-id-0') is None
+
+    # Events for the superseded descriptor are ignored
+    tracker.upload_started(util.base32_encode_str(b'descriptor-id-0'),
+                           HSDIR_A)
+    assert not tracker.upload_finished(HSDIR_A, succeeded=True)
+
+
+def test_upload_retry_backoff(mocker):
+    """
+    Test that failed uploads are retried with an exponential backoff and
+    dropped once they run out of retries
+    """
+    mocker.patch('onionbalance.upload.time.time', return_value=1000)
+    mocker.patch('onionbalance.config.UPLOAD_RETRY_INTERVAL', 5)
+    mocker.patch('onionbalance.config.UPLOAD_RETRY_MAX_INTERVAL', 15)
+    mocker.patch('onionbalance.config.UPLOAD_RETRIES', 3)
+    service = mock.Mock(onion_address='aaaaaaaaaaaaaaaa')
+    tracker = upload.UploadTracker()
+    tracker.expect(service, 0, 0, b'descriptor-id-0', 'signed', [HSDIR_A])
+    descriptor_upload = tracker.get_upload(b'descriptor-id-0')
+
+    # A rejected HSPOST queues the upload once
+    tracker.upload_error(descriptor_upload, [HSDIR_A])
+    tracker.upload_error(descriptor_upload, [HSDIR_A])
+    assert tracker.retry_queue_size() == 1
+    assert tracker.get_due_retries(now=1004) == []
+    assert tracker.get_due_retries(now=1005) == [descriptor_upload]
+    assert tracker.retry_queue_size() == 0
+
+    delays = []
+    for _ in range(3):
+        assert tracker.start_retry(descriptor_upload) == [HSDIR_A]
+        tracker.upload_started(descriptor_upload.descriptor_id, HSDIR_A)
+        tracker.upload_finished(HSDIR_A, succeeded=False)
+        retry_at, = tracker._retry_queue.values()
+        delays.append(retry_at - 1000)
+        tracker.get_due_retries(now=retry_at)
+    assert delays == [10, 15, 15]
+
+    # The upload ran out of retries
+    assert tracker.retry_queue_size() == 0
+
+
+def test_upload_retry_queue_bounded(mocker):
+    mocker.patch('onionbalance.config.UPLOAD_RETRY_QUEUE_SIZE', 2)
+    service = mock.Mock(onion_address='aaaaaaaaaaaaaaaa')
+    tracker = upload.UploadTracker()
+    for replica in range(3):
+        descriptor_id = ('descriptor-id-%d' % replica).encode()
+        tracker.expect(service, replica, 0, descriptor_id, 'signed', [])
+        tracker.upload_error(tracker.get_upload(descriptor_id), [])
+    assert tracker.retry_queue_size() == 2
+
+    # Superseded descriptors are not retried
+    tracker.expect(service, 2, 0, b'descriptor-id-3', 'signed', [])
+    due = tracker.get_due_retries(now=float('inf'))
+    assert [u.descriptor_id for u in due] == [
+        util.base32_encode_str(b'descriptor-id-1')]
+
+
+def test_upload_tracker_remove_service(mocker):
+    mocker.patch('onionbalance.upload.time.time', return_value=1000)
+    service = mock.Mock(onion_address='aaaaaaaaaaaaaaaa')
+    tracker = upload.UploadTracker()
+    tracker.expect(service, 0, 0, b'descriptor-id-0', 'signed', [HSDIR_A])
+    tracker.upload_error(tracker.get_upload(b'descriptor-id-0'), [HSDIR_A])
+    assert tracker.retry_queue_size() == 1
+
+    tracker.remove_service(service)
+    assert tracker.get_uploads(service) == []
+    assert tracker.retry_queue_size() == 0
+
+
+def test_upload_tracker_drops_superseded_in_progress_uploads():
+    """
+    Test that an HSDir with only superseded uploads in progress is removed
+    from the in progress index
+    """
+    service = mock.Mock(onion_address='aaaaaaaaaaaaaaaa')
+    tracker = upload.UploadTracker()
+    tracker.expect(service, 0, 0, b'descriptor-id-0', 'old', [HSDIR_A])
+    tracker.upload_started(util.base32_encode_str(b'descriptor-id-0'),
+                           HSDIR_A)
+    tracker.expect(service, 0, 0, b'descriptor-id-1', 'new', [HSDIR_A])
+
+    assert tracker.upload_finished(HSDIR_A, succeeded=True) is None
+    assert HSDIR_A not in tracker._in_progress
+
+
+def test_unmatched_fetch_failure_not_an_upload_failure(mocker):
+    """
+    Test that a late FAILED event for a fetch does not fail an upload in
+    progress to the same HSDir
+    """
+    service = mock.Mock(onion_address='aaaaaaaaaaaaaaaa')
+    tracker = upload.UploadTracker()
+    mocker.patch.object(upload, 'upload_tracker', tracker)
+    mocker.patch.object(instance, 'fetch_tracker', instance.FetchTracker())
+    tracker.expect(service, 0, 0, b'descriptor-id-0', 'signed',
+                   [HSDIR_A, HSDIR_B])
+    descriptor_id = util.base32_encode_str(b'descriptor-id-0')
+    tracker.upload_started(descriptor_id, HSDIR_A)
+    tracker.upload_started(descriptor_id, HSDIR_B)
+
+    def failed_event(descriptor_id, hsdir):
+        return mock.Mock(action=stem.HSDescAction.FAILED,
+                         descriptor_id=descriptor_id,
+                         address='bbbbbbbbbbbbbbbb',
+                         directory_fingerprint=hsdir, reason='NOT_FOUND')
+
+    eventhandler.EventHandler.new_desc(
+        failed_event('fetchdescriptorid', HSDIR_A))
+    eventhandler.EventHandler.new_desc(failed_event(None, HSDIR_B))
+    assert tracker.upload_finished(HSDIR_A, succeeded=True)
+
+    descriptor_upload, = tracker.get_uploads(service)
+    assert descriptor_upload.confirmed == [HSDIR_A]
+    assert descriptor_upload.failed == [HSDIR_B]
@@ -265,3 +265,28 @@ def test_is_directory_empty_not_empty(mocker):
     # Directory is empty
     mocker.patch('os.listdir', return_value=['filename'])
     assert not is_directory_empty('dir_not_empty/')
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+
+    # 'b' is now the least recently used item and is evicted
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_discard_values():
+    cache = LRUCache(3)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('c', 1)
+    cache.discard_values(1)
+    assert 'a' not in cache and 'c' not in cache
+    assert cache.get('b') == 2